@@ -2,9 +2,19 @@ import streamlit as st
 import pandas as pd
 import os
 import json
-import re
+import hashlib
+import time
+import uuid
 from datetime import date, timedelta
 
+# 讀檔、需求展開與 MRP 推演都在 shortage_engine (不依賴 Streamlit，可供批次/命令列使用)
+from shortage_engine import (
+    FILES, STOCK_SOURCES, MasterData, master_fingerprint, JobRunner,
+    parse_mps_workbook, mps_plan_lines, parse_supplier_files, run_netting, renet_plan_delta, run_scenarios,
+    BUCKET_FREQS, EXPORT_TABLES, EXPORT_FORMATS, export_bytes, render_simulation_table, render_grouped_html_table, StageRecorder, records_to_jsonl, start_memory_trace, stop_memory_trace,
+)
+from plan_store import PlanStore, PLAN_DB
+
 # ==========================================
 # 1. 網頁基本設定
 # ==========================================
@@ -13,36 +23,84 @@ st.set_page_config(page_title="電池模組缺料分析系統", layout="wide", p
 # ==========================================
 # 2. 全域變數與存檔設定
 # ==========================================
-FILES = {
-    "bom": "缺料預估.xlsx",       
-    "stock_w08": "庫存明細表.xlsx", 
-    "stock_w26": "W26庫存明細表.xlsx"
-}
-PLAN_FILE = "schedule.json"
+PLAN_FILE = "schedule.json"  # 舊版存檔；現作為插單匯入/匯出格式
+PAGE_SIZES = [50, 100, 200, "全部"]
+
+# 上傳檔解析快取：以檔案內容雜湊為鍵，整個伺服器行程共用
+UPLOAD_CACHE_SIZE = 256
+RESULT_CACHE_SIZE = 32
+STAGE_LOG_SIZE = 2000  # 效能診斷保留的量測筆數 (整個 session)
+JOB_POLL_SECONDS = 0.25  # 等待背景工作時更新進度的間隔
+EXPORT_MIMES = {"xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+BUCKET_STYLE_CELLS = 100_000  # 分期矩陣超過此格數就不上色 (Styler 太慢)
+SCENARIO_COLUMNS = ["情境", "插單日期", "型號", "數量", "MPS平移天數", "忽略天數", "排除現有插單"]
 
 if 'read_errors' not in st.session_state: st.session_state.read_errors = {}
 if 'debug_logs' not in st.session_state: st.session_state.debug_logs = []
+if 'stage_log' not in st.session_state: st.session_state.stage_log = []
+if 'job_owner' not in st.session_state: st.session_state.job_owner = uuid.uuid4().hex
+
+# 本次執行的各階段耗時；記憶體峰值量測較慢，只在診斷面板勾選時開啟
+recorder = StageRecorder(trace_memory=st.session_state.get('trace_memory', False))
 
 missing = []
 for k, f in FILES.items():
     if not os.path.exists(f): missing.append(f)
 
-individual_w08 = {} 
-individual_w26 = {}
-
 def rerun_app():
     if hasattr(st, 'rerun'): st.rerun()
     else: st.experimental_rerun()
 
-def load_plan():
-    if os.path.exists(PLAN_FILE):
-        try:
-            with open(PLAN_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-        except: return []
-    return []
-
-def save_plan(data):
-    with open(PLAN_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+@st.cache_resource(show_spinner=False)
+def plan_store():
+    # 所有 session 共用同一個 SQLite 存檔；第一次建立時自動匯入舊的 schedule.json (格式有誤時保留待下次啟動重試)
+    return PlanStore(PLAN_DB, legacy_json=PLAN_FILE)
+
+def refresh_plan():
+    # 只有插單版本變動 (自己或其他人新增/刪除) 時才重新讀取
+    version, lines = plan_store().changed_since(st.session_state.get('plan_version'))
+    if lines is not None: st.session_state.plan, st.session_state.plan_version = lines, version
+
+@st.cache_resource(show_spinner=False)
+def _upload_cache():
+    return {}
+
+def upload_digest(up_file): return hashlib.sha1(up_file.getvalue()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _result_cache():
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def _baseline_cache():
+    # 同一組主檔/排程檔/到貨下最近一次的推演結果，插單增刪或顯示範圍改變時以它為基準做增量重算
+    return {}
+
+def _cache_put(cache, key, value, max_size=UPLOAD_CACHE_SIZE):
+    cache[key] = value
+    while len(cache) > max_size: cache.pop(next(iter(cache)))
+
+@st.cache_resource(show_spinner=False)
+def job_runner():
+    # 讀檔、推演等耗時工作在伺服器行程共用的背景執行緒中執行
+    return JobRunner()
+
+def run_job(key, fn, label, n_stages):
+    # 送出背景工作並等待，期間顯示各階段進度。使用者在等待中改了輸入時，Streamlit 會在下一次更新進度時
+    # 中斷本次執行並重跑；重跑送出新工作時，沒人等待的舊工作隨即取消。相同輸入的工作只會算一次。
+    runner = job_runner()
+    job = runner.submit(key, fn, owner=st.session_state.job_owner, trace_memory=recorder.trace_memory)
+    if not job.done():
+        box = st.empty()
+        while not job.done():
+            done, current = job.progress()
+            box.progress(min(len(done) / n_stages, 0.95), text=f"⏳ {label}：{current or '等待開始'} ({len(done)}/{n_stages})")
+            time.sleep(JOB_POLL_SECONDS)
+        box.empty()
+    result = job.result()
+    recorder.records.extend(job.recorder.records)
+    runner.forget(key)
+    return result
 
 # ==========================================
 # 3. CSS 樣式 (Mobile 專用配置)
@@ -106,253 +164,110 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def get_base_part_no(raw_no):
-    s = str(raw_no).strip()
-    if len(s) > 0 and s[0] in '0123456789': s = "TW" + s
-    if '-' in s: return s.split('-')[0]
-    return s
-
-def normalize_key(part_no):
-    if pd.isna(part_no): return ""
-    s = str(part_no).upper().strip()
-    s = s.replace("TW", "").replace("-", "").replace(" ", "")
-    return s
-
-def read_excel_auto_header(file_path):
-    if not os.path.exists(file_path): return pd.DataFrame()
-    try:
-        df_preview = pd.read_excel(file_path, header=None, nrows=10, engine='openpyxl')
-        target_row = 0
-        found = False
-        for idx, row in df_preview.iterrows():
-            row_str = " ".join(row.astype(str).values)
-            if "品號" in row_str: target_row = idx; found = True; break
-        return pd.read_excel(file_path, header=target_row, engine='openpyxl')
-    except Exception as e:
-        st.session_state.read_errors[file_path] = str(e)
-        return pd.DataFrame()
-
-def clean_df(df):
-    if df.empty: return df
-    df.columns = [str(c).strip() for c in df.columns]
-    part_col = next((c for c in df.columns if '品號' in c), None)
-    if part_col:
-        df = df.dropna(subset=[part_col]) 
-        df = df[~df[part_col].astype(str).str.contains('小計|合計|總計', na=False)]
-    return df
-
-def load_data(files):
-    st.session_state.read_errors = {}
-    df_bom = read_excel_auto_header(files["bom"])
-    df_w08 = read_excel_auto_header(files["stock_w08"])
-    df_w26 = read_excel_auto_header(files["stock_w26"])
-    if df_w26.empty and files["stock_w26"] not in st.session_state.read_errors:
-        st.session_state.debug_logs.append(f"⚠️ {files['stock_w26']} 內容為空或讀取失敗")
-    return clean_df(df_bom), clean_df(df_w08), clean_df(df_w26)
+@st.cache_resource(show_spinner=False)
+def master_data():
+    # 主檔只在整個伺服器行程讀一次；來源檔變動時自動重建並整個換上新快照
+    return MasterData(FILES, STOCK_SOURCES)
+
+def parsed_mps(uploaded_file):
+    cache = _upload_cache()
+    key = ('mps', upload_digest(uploaded_file))
+    if key not in cache: _cache_put(cache, key, parse_mps_workbook(uploaded_file.getvalue()))
+    return cache[key]
 
 def process_mps_file(uploaded_file, ignore_days=1):
-    mps_list = []
-    log_msg = []
-    try:
-        df = pd.read_excel(uploaded_file, engine='openpyxl')
-        date_col = next((c for c in df.columns if 'Date' in str(c) or '日期' in str(c)), None)
-        if not date_col: return [], ["❌ 找不到 [Date] 欄位"]
-        
-        target_cols = []
-        for c in df.columns:
-            clean_c = str(c).replace('\n', '').replace(' ', '')
-            if '計畫' in clean_c and '產出' in clean_c:
-                model_name = clean_c.replace('計畫', '').replace('產出', '').strip()
-                if model_name: target_cols.append({'col': c, 'model': model_name})
-        if not target_cols: return [], ["⚠️ 找不到任何 [計畫產出] 欄位"]
-
-        today = date.today()
-        cutoff_date = today + timedelta(days=ignore_days)
-        count = 0
-        skip_count = 0
-        
-        for _, row in df.iterrows():
-            try:
-                raw_date = row[date_col]
-                dt_obj = pd.to_datetime(raw_date)
-                if dt_obj.date() < cutoff_date:
-                    skip_count += 1
-                    continue
-                plan_date_str = dt_obj.strftime('%Y-%m-%d')
-                for t in target_cols:
-                    qty = row[t['col']]
-                    if pd.notna(qty):
-                        try:
-                            qty_val = float(qty)
-                            if qty_val > 0:
-                                mps_list.append({'日期': plan_date_str, '型號': t['model'], '數量': int(qty_val), 'source': 'MPS'})
-                                count += 1
-                        except: pass
-            except: continue
-        log_msg.append(f"✅ 匯入 {count} 筆 (已過濾 {cutoff_date.strftime('%m/%d')} 之前的舊資料)")
-        return mps_list, log_msg
-    except Exception as e:
-        return [], [f"❌ MPS 讀取失敗: {str(e)}"]
+    long_df, err = parsed_mps(uploaded_file)
+    if err: return [], [err]
+
+    # 解析結果已快取，ignore_days 改變時只重跑日期篩選
+    mps_list, cutoff_date = mps_plan_lines(long_df, ignore_days)
+    return mps_list, [f"✅ 匯入 {len(mps_list)} 筆 (已過濾 {cutoff_date.strftime('%m/%d')} 之前的舊資料)"]
 
 def process_supplier_uploads(uploaded_files):
     supply_list = []
     log_msg = []
     if not uploaded_files: return [], []
-    for up_file in uploaded_files:
-        try:
-            df_raw = pd.read_excel(up_file, header=None, engine='openpyxl')
-            header_row_idx = -1; part_col_idx = -1
-            for r in range(min(15, len(df_raw))):
-                row_vals = df_raw.iloc[r].astype(str).values
-                for c, val in enumerate(row_vals):
-                    if "品號" in val: header_row_idx = r; part_col_idx = c; break
-                if header_row_idx != -1: break
-            if header_row_idx == -1: log_msg.append(f"❌ {up_file.name}: 未偵測到品號欄"); continue
-            date_col_map = {}
-            scan_start = max(0, header_row_idx - 1)
-            scan_end = min(len(df_raw), header_row_idx + 6)
-            for r in range(scan_start, scan_end):
-                temp_map = {}
-                for c in range(len(df_raw.columns)):
-                    val = df_raw.iloc[r, c]
-                    try:
-                        dt = pd.to_datetime(val, errors='coerce')
-                        if pd.notna(dt): temp_map[c] = dt.strftime('%Y-%m-%d')
-                    except: continue
-                if temp_map: date_col_map = temp_map; break
-            if not date_col_map: log_msg.append(f"⚠️ {up_file.name}: 未偵測到日期欄"); continue
-            data_start_row = header_row_idx + 1
-            count = 0
-            for r in range(data_start_row, len(df_raw)):
-                try:
-                    p_no = str(df_raw.iloc[r, part_col_idx]).strip()
-                    if not p_no or p_no.lower() == 'nan': continue
-                    for c_idx, date_str in date_col_map.items():
-                        qty_val = df_raw.iloc[r, c_idx]
-                        try:
-                            qty = float(qty_val)
-                            if qty > 0:
-                                supply_list.append({'date': date_str, 'type': 'supply', 'note': "🚛 到貨", 'part_no': p_no, 'match_key': normalize_key(p_no), 'qty': qty})
-                                count += 1
-                        except: continue
-                except: continue
-            log_msg.append(f"✅ {up_file.name}: {count} 筆")
-        except Exception as e: log_msg.append(f"❌ {up_file.name}: {str(e)}")
+    cache = _upload_cache()
+    keys = [('supplier', upload_digest(f)) for f in uploaded_files]
+    results = {k: cache[k] for k in keys if k in cache}
+    misses = {k: f for k, f in zip(keys, uploaded_files) if k not in results}
+    if misses:
+        # 只有新檔案需要解析 (背景執行)
+        blobs = [f.getvalue() for f in misses.values()]
+        def parse_job(rec):
+            with rec.stage("supplier_parse", rows_in=len(blobs)) as r:
+                parsed = parse_supplier_files(blobs)
+                r['rows_out'] = sum(len(rows) for rows, _, _ in parsed)
+            return parsed
+        for k, result in zip(misses, run_job(('supplier',) + tuple(k[1] for k in misses), parse_job, "解析供應商交期檔", 1)):
+            results[k] = result
+            _cache_put(cache, k, result)
+    for k, up_file in zip(keys, uploaded_files):
+        supplies, icon, msg = results[k]
+        supply_list.extend(supplies)
+        log_msg.append(f"{icon} {up_file.name}: {msg}")
     return supply_list, log_msg
 
-def process_stock(df, store_type):
-    if df.empty: return
-    try:
-        candidates = [c for c in df.columns if '數量' in c]
-        stock_cols = [c for c in candidates if '庫存' in c]
-        col_q = stock_cols[0] if stock_cols else (candidates[0] if candidates else None)
-        if not col_q: return
-        col_p = next(c for c in df.columns if '品號' in c)
-        if store_type == 'W08':
-            col_wh = next((c for c in df.columns if '庫別' in c), None)
-            if col_wh: df = df[df[col_wh].astype(str).str.strip() == 'W08']
-        df[col_q] = pd.to_numeric(df[col_q], errors='coerce').fillna(0)
-        for _, row in df.iterrows():
-            raw_p = str(row[col_p]).strip()
-            stock_base = get_base_part_no(raw_p)
-            qty = row[col_q]
-            if store_type == 'W08': individual_w08[stock_base] = individual_w08.get(stock_base, 0) + qty
-            else: individual_w26[stock_base] = individual_w26.get(stock_base, 0) + qty
-    except: pass
-
-def render_grouped_html_table(grouped_data):
-    html = '<div class="table-wrapper"><table style="width:100%;">'
-    html += """
-    <colgroup>
-        <col style="width: 60px">   <col style="width: 150px">  <col style="width: 80px">   <col style="width: 220px">  <col style="width: 200px">  <col style="width: 60px">   <col style="width: 80px">   <col style="width: 80px">   <col style="width: 80px">   <col style="width: 80px">   </colgroup>
-    <thead><tr><th>狀態</th><th>首個斷料點</th><th>型號 (受影響)</th><th>品號 / 群組內容</th><th>品名</th><th>用量</th><th>W08</th><th>W26</th><th>總需求</th><th>最終結餘</th></tr></thead><tbody>
-    """
-    def fmt(n): return f"{int(n):,}"
-    for group in grouped_data:
-        is_short = group['final_balance'] < 0
-        count = len(group['items'])
-        is_group = count > 1
-        tr_style = 'color: #333;'
-        bg_class = 'background-color: #FFEBEE;' if is_short else 'background-color: white;'
-        if is_short: tr_style = 'color: #c0392b; font-weight: 500;'
-        
-        html += f'<tr style="{tr_style} {bg_class}">'
-        status_html = '<span class="badge badge-err">缺料</span>' if is_short else '<span class="badge badge-ok">充足</span>'
-        html += f'<td class="text-center">{status_html}</td>'
-        
-        first_shortage = group.get('first_shortage_info', '-')
-        shortage_style = "color: #c0392b; font-weight: bold;" if is_short else "color: #aaa;"
-        html += f'<td class="text-center" style="{shortage_style}">{first_shortage}</td>'
-        
-        html += f'<td class="text-center" style="text-align: center !important;">{group["model"]}</td>'
-        
-        if is_group or group['simulation_logs']:
-            details_inner = ""
-            if is_group:
-                for item in group['items']:
-                    details_inner += f'<div style="border-bottom:1px dashed #ccc; padding:6px 0;"><div><span style="color:#444; font-weight:bold;">{item["p_no"]}</span></div><div style="font-size:14px; color:#555;">W08:<b>{fmt(item["w08"])}</b> | W26:<b>{fmt(item["w26"])}</b></div></div>'
-            sim_table_html = ""
-            if group['simulation_logs']:
-                sim_rows = ""
-                for log in group['simulation_logs']:
-                    row_cls = "sim-row-supply" if log['type'] == 'supply' else ("sim-row-short" if log['balance'] < 0 else "")
-                    qty_display = f"+{fmt(log['qty'])}" if log['type'] == 'supply' else f"-{fmt(log['qty'])}"
-                    sim_rows += f'<tr class="{row_cls}"><td>{log["date"]}</td><td>{log["note"]}</td><td style="text-align:center;">{qty_display}</td><td style="text-align:center;">{fmt(log["balance"])}</td></tr>'
-                sim_table_html = f"""<div class="sim-wrapper" style="margin-top: 10px;"><b style="color:#2c3e50;">📅 MRP模擬：</b><table class="sim-table"><thead><tr><th>日期</th><th>摘要</th><th>變動</th><th>結餘</th></tr></thead><tbody>{sim_rows}</tbody></table></div>"""
-            summary_text = f"📦 共用料 ({count})" if is_group else group['items'][0]['p_no']
-            details_box = f'<div style="font-size:14px; margin-top:5px; padding-left:5px; border-left:3px solid #ddd;">{details_inner}{sim_table_html}</div>'
-            html += f'<td><details><summary>{summary_text}</summary>{details_box}</details></td>'
-        else:
-            html += f'<td>{group["items"][0]["p_no"]}</td>'
-
-        html += f'<td style="text-align: left !important;">{group["items"][0]["name"]}</td>'
-        
-        usage = max([i['usage'] for i in group['items']])
-        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{usage}</span></td>'
-        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["total_w08"])}</span></td>'
-        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["total_w26"])}</span></td>'
-        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["total_demand"])}</span></td>'
-        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["final_balance"])}</span></td></tr>'
-    html += '</tbody></table></div>'
-    return html
-
-df_bom_src, df_w08_src, df_w26_src = load_data(FILES)
+def show_bucket_matrix(rows, matrix):
+    # 群組 × 期間的期末結餘，負數 (缺料) 標紅
+    frame = matrix.to_frame(rows)
+    periods = list(frame.columns[4:])
+    if frame.size <= BUCKET_STYLE_CELLS:
+        frame = frame.style.map(lambda v: 'background-color: #ffebee; color: #c0392b; font-weight: bold' if v < 0 else '', subset=periods).format('{:,.0f}', subset=periods)
+    st.dataframe(frame, hide_index=True)
+
+def scenarios_from_editor(rows):
+    # 編輯表每列為一筆插單；同名情境的列合併，平移/忽略天數/排除現有插單取該情境第一個有填的值
+    scenarios = {}
+    for r in rows.to_dict('records'):
+        name = str(r.get('情境') or '').strip()
+        if not name: continue
+        s = scenarios.setdefault(name, {'name': name, 'add': []})
+        if pd.notna(r.get('插單日期')) and r.get('型號') and pd.notna(r.get('數量')) and int(r['數量']) > 0:
+            s['add'].append({'日期': pd.Timestamp(r['插單日期']).strftime('%Y-%m-%d'), '型號': r['型號'], '數量': int(r['數量'])})
+        if pd.notna(r.get('MPS平移天數')): s.setdefault('shift_mps_days', int(r['MPS平移天數']))
+        if pd.notna(r.get('忽略天數')): s.setdefault('ignore_days', int(r['忽略天數']))
+        if r.get('排除現有插單'): s['replace_manual'] = True
+    return list(scenarios.values())
+# 主檔需要 (重新) 讀取時交給背景工作並顯示進度；本次執行全程使用同一份快照，期間主檔被更新也不會前後不一致
+if not master_data().is_current():
+    run_job(('master', master_fingerprint(FILES)), lambda rec: master_data().get(rec), "讀取主檔", len(FILES) + 3)
+master = master_data().get(recorder)
+st.session_state.read_errors = master['read_errors']
+st.session_state.debug_logs = list(master['logs'])
+df_bom_src = master['df_bom']
 
 if df_bom_src is not None:
-    if 'plan' not in st.session_state: st.session_state.plan = load_plan()
-
-    try:
-        c_model = next(c for c in df_bom_src.columns if '型號' in c)
-        c_part = next(c for c in df_bom_src.columns if '品號' in c)
-        c_code = next((c for c in df_bom_src.columns if '項目' in c or '代號' in c), None)
-        c_name = next((c for c in df_bom_src.columns if '品名' in c), None)
-        c_usage = next((c for c in df_bom_src.columns if '用量' in c), None)
-    except: st.error("BOM 表欄位偵測失敗"); st.stop()
-
-    if c_code:
-        df_bom_src[c_code] = df_bom_src[c_code].fillna('').astype(str)
-        df_bom_src['_sort_num'] = df_bom_src[c_code].str.extract('(\d+)').astype(float).fillna(0)
-        df_bom_sorted = df_bom_src.sort_values(by=[c_model, '_sort_num', c_part])
-    else:
-        df_bom_sorted = df_bom_src.sort_values(by=[c_model, c_part])
+    refresh_plan()
+
+    bom_cols = master['bom_cols']
+    if bom_cols is None: st.error("BOM 表欄位偵測失敗"); st.stop()
+    df_bom_sorted = master['df_bom_sorted']
 
-    unique_models = df_bom_sorted[c_model].dropna().unique().tolist()
+    unique_models = master['unique_models']
     
     with st.sidebar:
         if missing: st.error("⚠️ 檔案缺失！" + str(missing)); st.stop()
         
         st.markdown("### ⚙️ 參數設定")
         ignore_days = st.number_input("已領料/忽略排程天數", min_value=0, value=1, step=1, help="輸入 N，則系統會忽略「今天 + N天」內的排程需求。")
+        bucket_freq = st.selectbox("推演顯示", [None] + list(BUCKET_FREQS), format_func=lambda f: "逐筆明細" if f is None else f"分期矩陣 ({BUCKET_FREQS[f]})",
+                                   help="分期矩陣：需求與到貨依日/週/月加總，顯示各期期末結餘；週/月期間內先缺後補回的不算斷料")
         st.markdown("---")
 
         st.header("1. 供應商交期")
         supplier_files = st.file_uploader("上傳供應商 Excel", accept_multiple_files=True, type=['xlsx', 'xls'], key="sup_uploader")
         if supplier_files:
             s_list, s_logs = process_supplier_uploads(supplier_files)
-            with st.expander("📊 讀取結果診斷", expanded=False):
+            # 對不到 BOM 料號的到貨不會計入推演，列出來讓使用者檢查品號寫法
+            unresolved = master['identity'].unresolved_supplies(s_list)
+            with st.expander("📊 讀取結果診斷" + (f" (⚠️ {len(unresolved)} 個品號未對應)" if len(unresolved) else ""), expanded=False):
                 for log in s_logs:
                     if "❌" in log: st.error(log)
                     else: st.success(log)
+                if len(unresolved):
+                    st.warning(f"⚠️ {int(unresolved['筆數'].sum())} 筆到貨對不到 BOM 料號，未計入推演")
+                    st.dataframe(unresolved, hide_index=True)
         else: s_list = []
 
         st.markdown("---")
@@ -361,10 +276,14 @@ if df_bom_src is not None:
         mps_file = st.file_uploader("📂 上傳排程計畫 (xlsx)", type=['xlsx', 'xls'])
         mps_data = []
         if mps_file:
-            mps_data, mps_logs = process_mps_file(mps_file, ignore_days=ignore_days)
+            with recorder.stage("mps_parse") as rec:
+                mps_data, mps_logs = process_mps_file(mps_file, ignore_days=ignore_days)
+                rec['rows_out'] = len(mps_data)
             for log in mps_logs:
                 if "❌" in log: st.error(log)
                 else: st.success(log)
+            unknown_models = master['identity'].unresolved_models(mps_data)
+            if len(unknown_models): st.warning(f"⚠️ 排程型號不在 BOM 中 (不產生需求)：{', '.join(unknown_models['型號'])}")
 
         st.markdown("---")
         st.markdown("**或 手動輸入插單：**")
@@ -376,31 +295,33 @@ if df_bom_src is not None:
                 try: q_in = int(q_str)
                 except: q_in = 0
                 if q_in > 0:
-                    st.session_state.plan.append({'日期': date_in.strftime('%Y-%m-%d'), '型號': m_sel, '數量': q_in})
-                    save_plan(st.session_state.plan); rerun_app()
+                    plan_store().add(date_in.strftime('%Y-%m-%d'), m_sel, q_in); rerun_app()
         
         if st.session_state.plan:
             st.markdown("###### 📝 手動插單列表")
-            sorted_plan = sorted(enumerate(st.session_state.plan), key=lambda x: x[1]['日期'])
-            for original_idx, item in sorted_plan:
+            sorted_plan = sorted(st.session_state.plan, key=lambda x: x['日期'])
+            for item in sorted_plan:
                 c1, c2 = st.columns([5, 1])
                 d_str = pd.to_datetime(item['日期']).strftime('%m/%d')
                 info_text = f"**{d_str}** | <small>{item['型號']}</small> | **{item['數量']:,}**"
                 with c1: st.markdown(info_text, unsafe_allow_html=True)
                 with c2:
-                    if st.button("✖", key=f"del_{original_idx}"):
-                        st.session_state.plan.pop(original_idx)
-                        save_plan(st.session_state.plan); rerun_app()
+                    if st.button("✖", key=f"del_{item['id']}"):
+                        plan_store().delete(item['id']); rerun_app()
                 st.markdown("<hr style='margin: 2px 0; border-top: 1px dashed #eee;'>", unsafe_allow_html=True)
-            if st.button("🗑️ 清空手動排程"): st.session_state.plan = []; save_plan([]); rerun_app()
+            if st.button("🗑️ 清空手動排程"): plan_store().clear(); rerun_app()
+        if plan_store().legacy_error: st.warning(f"⚠️ 舊的插單檔無法匯入，已保留原檔，修正後重新啟動即會再匯入：{plan_store().legacy_error}")
+        with st.expander("💾 插單匯入 / 匯出 (JSON)", expanded=False):
+            st.download_button("⬇️ 匯出", plan_store().export_json(), file_name=PLAN_FILE, mime="application/json")
+            plan_json = st.file_uploader("匯入 (取代目前的手動插單)", type=['json'], key="plan_import")
+            if plan_json and st.button("📥 匯入"):
+                try: plan_store().import_json(json.loads(plan_json.getvalue().decode('utf-8'))); rerun_app()
+                except (ValueError, KeyError, TypeError) as e: st.error(f"❌ 匯入失敗: {e}")
             
-        if 'W26庫存明細表.xlsx' in st.session_state.read_errors:
-            st.error(f"🔴 W26 讀取失敗！原因：\n{st.session_state.read_errors['W26庫存明細表.xlsx']}")
+        for wh, (file_key, _) in STOCK_SOURCES.items():
+            if FILES[file_key] in st.session_state.read_errors:
+                st.error(f"🔴 {wh} 讀取失敗！原因：\n{st.session_state.read_errors[FILES[file_key]]}")
 
-    process_stock(df_w08_src, 'W08')
-    process_stock(df_w26_src, 'W26')
-
-    ledger = {} 
     total_plan_qty = 0
     active_models = [] 
     
@@ -410,150 +331,64 @@ if df_bom_src is not None:
     if mps_data: all_plans.extend(mps_data)
 
     if all_plans:
-        sorted_plan_data = sorted(all_plans, key=lambda x: x['日期'])
-        active_models = list(set([p['型號'] for p in sorted_plan_data]))
-        for item in sorted_plan_data:
-            plan_date, plan_model, plan_qty = item['日期'], item['型號'], item['數量']
-            source_note = "MPS" if item.get('source') == 'MPS' else "手動"
-            total_plan_qty += plan_qty
-            model_bom = df_bom_sorted[df_bom_sorted[c_model] == plan_model]
-            model_reqs = {}
-            for _, r in model_bom.iterrows():
-                p_no = str(r[c_part]).strip()
-                norm_k = normalize_key(p_no)
-                try: usage = float(r.get(c_usage, 0))
-                except: usage = 0
-                if usage > model_reqs.get(norm_k, 0): model_reqs[norm_k] = usage
-            for k, u in model_reqs.items():
-                if k not in ledger: ledger[k] = []
-                ledger[k].append({'date': plan_date, 'type': 'demand', 'note': f"生產({source_note}): {plan_model}", 'qty': plan_qty * u})
-
-    normalized_map = {}
-    for k in ledger.keys():
-        norm_k = normalize_key(k)
-        if norm_k not in normalized_map: normalized_map[norm_k] = []
-        normalized_map[norm_k].append(k)
-
-    if s_list:
-        for s in s_list:
-            sup_norm_key = s['match_key']
-            if sup_norm_key in normalized_map:
-                for target_key in normalized_map[sup_norm_key]:
-                    ledger[target_key].append(s)
-            else:
-                if s['part_no'] not in ledger: ledger[s['part_no']] = []
-                ledger[s['part_no']].append(s)
+        active_models = list(set([p['型號'] for p in all_plans]))
+        total_plan_qty = sum(p['數量'] for p in all_plans)
 
     st.markdown(f'<h2 class="app-title">🔋 電池模組缺料分析系統</h2>', unsafe_allow_html=True)
 
-    c_filter, c_search_no, c_search_name = st.columns([1, 1, 1])
+    c_filter, c_search = st.columns([1, 2])
     with c_filter: sel_filter = st.selectbox("🔍 篩選機種", ["全部顯示"] + unique_models)
-    with c_search_no: search_no = st.text_input("搜尋品號 (Part No.)", "")
-    with c_search_name: search_name = st.text_input("搜尋品名 (Name)", "")
+    search_help = "多個關鍵字以空白分隔 (需全部符合)；結尾加 * 為開頭比對，如 TW401*"
+    with c_search:
+        # 兩個搜尋框放在同一個表單：改完按 Enter 或 🔍 才一次套用，輸入途中不會觸發重跑
+        with st.form("search_form", border=False):
+            c_search_no, c_search_name, c_go = st.columns([6, 6, 1], vertical_alignment="bottom")
+            with c_search_no: search_no = st.text_input("搜尋品號 (Part No.)", "", help=search_help)
+            with c_search_name: search_name = st.text_input("搜尋品名 (Name)", "", help=search_help)
+            with c_go: st.form_submit_button("🔍")
     
-    if sel_filter == "全部顯示": target_df = df_bom_sorted[df_bom_sorted[c_model].isin(active_models)] if active_models else df_bom_sorted
-    else: target_df = df_bom_sorted[df_bom_sorted[c_model] == sel_filter]
-
-    # ★★★ 修改核心：合併共用料 (Consolidate by Part) ★★★
-    consolidated_groups = {}
-    
-    for _, row in target_df.iterrows():
-        p_no = str(row[c_part]).strip()
-        bom_base = get_base_part_no(p_no)
-        p_code = str(row.get(c_code, '')).strip()
-        model = row[c_model]
-        
-        # 鍵值：如果有群組代碼就用代碼，否則用料號
-        key = p_code if (p_code and p_code.lower()!='nan') else p_no
-        
-        my_w08 = individual_w08.get(bom_base, 0)
-        my_w26 = individual_w26.get(bom_base, 0)
-        item_data = {'p_no': p_no, 'base': bom_base, 'name': row.get(c_name, ''), 'usage': float(row.get(c_usage, 0)), 'w08': my_w08, 'w26': my_w26, 'net_stock': my_w08 + my_w26}
-
-        if key not in consolidated_groups:
-            consolidated_groups[key] = {
-                'models': {model}, # 使用 Set 來自動去重型號
-                'code': p_code, 
-                'items': [item_data], 
-                'req_key': key, 
-                'total_w08': my_w08, 
-                'total_w26': my_w26, 
-                'total_net': my_w08 + my_w26,
-                'seen_parts': {bom_base}
-            }
+    if sel_filter == "全部顯示": scope_models = active_models if active_models else None
+    else: scope_models = [sel_filter]
+
+    # 推演結果依輸入指紋快取；搜尋、缺料切換只是對快取結果的篩選，不會重跑 MRP
+    result_key = (
+        master['fingerprint'],
+        st.session_state.plan_version,
+        upload_digest(mps_file) if mps_file else None,
+        str(date.today() + timedelta(days=ignore_days)),
+        tuple(upload_digest(f) for f in supplier_files) if supplier_files else (),
+        None if scope_models is None else frozenset(scope_models),
+        bucket_freq,
+    )
+    results = _result_cache()
+    cache_hit = result_key in results
+    if not cache_hit:
+        if bucket_freq:
+            # 分期矩陣直接走分期推演 (不產生逐筆記錄)；排序、缺料狀態都以分期結果為準
+            netting_job = lambda rec: run_netting(df_bom_sorted, bom_cols, master['stock_table'], all_plans, s_list, scope_models, rec, bucket_freq, master['identity'])
+            netting = run_job(('netting',) + result_key, netting_job, "分期推演", 3)
         else:
-            group = consolidated_groups[key]
-            group['models'].add(model)
-            if bom_base not in group['seen_parts']:
-                group['items'].append(item_data)
-                group['total_w08'] += my_w08
-                group['total_w26'] += my_w26
-                group['total_net'] += (my_w08 + my_w26)
-                group['seen_parts'].add(bom_base)
-
-    grouped_data = list(consolidated_groups.values())
-    for g in grouped_data:
-        g['model'] = ", ".join(sorted(list(g['models'])))
-
-    processed_list = []
-    shortage_count = 0
-    total_items = 0
-    
-    for g in grouped_data:
-        p_no_check = g['items'][0]['p_no']
-        p_name_check = g['items'][0]['name']
-        match_no = True if not search_no else (search_no.lower() in p_no_check.lower())
-        match_name = True if not search_name else (search_name.lower() in p_name_check.lower())
-        
-        if match_no and match_name:
-            running_balance = g['total_net']
-            total_demand = 0
-            first_shortage_info = "-"
-            simulation_logs = []
-            unique_demands = {} 
-            supplies = []
-            
-            processed_ledger_keys = set()
-            for item in g['items']:
-                k = normalize_key(item['p_no'])
-                if k in ledger and k not in processed_ledger_keys:
-                    processed_ledger_keys.add(k)
-                    for entry in ledger[k]:
-                        if entry['type'] == 'demand':
-                            d_key = (entry['date'], entry['note'])
-                            # ★★★ 關鍵修正：對於同一工單的群組料，取最大值而非累加 ★★★
-                            if d_key not in unique_demands: unique_demands[d_key] = entry['qty']
-                            else: unique_demands[d_key] = max(unique_demands[d_key], entry['qty'])
-                        else: supplies.append(entry)
-            
-            movements = supplies + [{'date': k[0], 'note': k[1], 'type': 'demand', 'qty': v} for k, v in unique_demands.items()]
-            movements.sort(key=lambda x: x['date'])
-            
-            for m in movements:
-                if m['type'] == 'demand':
-                    running_balance -= m['qty']
-                    if m['qty'] > 0: total_demand += m['qty']
-                    if running_balance < 0 and first_shortage_info == "-":
-                        first_shortage_info = f"{m['date']} ({m['note']})"
-                elif m['type'] == 'supply': running_balance += m['qty']
-                simulation_logs.append({'date': m['date'], 'note': m['note'], 'type': m['type'], 'qty': m['qty'], 'balance': running_balance})
-            
-            g['total_demand'] = total_demand
-            g['final_balance'] = running_balance
-            g['first_shortage_info'] = first_shortage_info
-            g['simulation_logs'] = simulation_logs
-            if g['final_balance'] < 0: shortage_count += 1
-            total_items += 1
-            processed_list.append(g)
-
-    def sort_by_shortage_date(item):
-        if item['final_balance'] >= 0:
-            return "9999-99-99" 
-        info = item.get('first_shortage_info', '-')
-        if info == '-': return "9999-99-99"
-        return info.split(' ')[0] 
-
-    processed_list.sort(key=sort_by_shortage_date)
+            # 只有手動排程或顯示範圍不同時 (如「全部顯示」下插單加入新型號)，沿用同條件下上一次的結果做增量推演
+            base_key = result_key[:1] + result_key[2:5] + result_key[6:]
+            baselines = _baseline_cache()
+            prev = baselines.get(base_key)
+            def netting_job(rec):
+                if prev is not None: return renet_plan_delta(prev, all_plans, rec, df_bom_sorted, bom_cols, scope_models)
+                return run_netting(df_bom_sorted, bom_cols, master['stock_table'], all_plans, s_list, scope_models, rec, identity=master['identity'])
+            netting = run_job(('netting',) + result_key, netting_job, "缺料推演", 2 if prev is not None and prev.get('scope') == result_key[5] else 3)
+            _cache_put(baselines, base_key, netting, RESULT_CACHE_SIZE)
+        _cache_put(results, result_key, netting, RESULT_CACHE_SIZE)
+    netting = results[result_key]
+    matrix = netting.get('buckets')
+
+    with recorder.stage("filter", rows_in=len(netting['groups']), cached=cache_hit) as rec:
+        # 搜尋走主檔快照的索引 (含共用料中的每個替代料號)，只篩選快取的推演結果
+        hits = master['search_index'].matching_groups({'part': search_no, 'name': search_name}, scope_models)
+        processed_list = netting['groups'] if hits is None else [g for g in netting['groups'] if g['req_key'] in hits]
+        rec['rows_out'] = len(processed_list)
+
+    total_items = len(processed_list)
+    shortage_count = sum(1 for g in processed_list if g['final_balance'] < 0)
 
     if 'show_shortage_only' not in st.session_state: st.session_state.show_shortage_only = False
     def toggle_shortage_view(): st.session_state.show_shortage_only = not st.session_state.show_shortage_only
@@ -570,9 +405,97 @@ if df_bom_src is not None:
     if st.session_state.show_shortage_only: final_display_list = [g for g in processed_list if g['final_balance'] < 0]
     else: final_display_list = processed_list
 
-    if final_display_list: st.markdown(render_grouped_html_table(final_display_list), unsafe_allow_html=True)
+    if final_display_list:
+        # 分頁：只產生目前頁面的 HTML；MRP 模擬表改由「明細」區按需產生
+        c_size, c_page, c_detail = st.columns([1, 1, 2])
+        with c_size: page_size = st.selectbox("每頁筆數", PAGE_SIZES, index=1, key="page_size")
+        if page_size == "全部":
+            with recorder.stage("render", rows_in=len(final_display_list)) as rec:
+                if matrix is not None: show_bucket_matrix(final_display_list, matrix)
+                else: st.markdown(render_grouped_html_table(final_display_list, netting['warehouses']), unsafe_allow_html=True)
+                rec['rows_out'] = len(final_display_list)
+        else:
+            n_pages = (len(final_display_list) - 1) // page_size + 1
+            with c_page:
+                page_no = min(st.number_input("頁次", min_value=1, value=1, step=1, key="page_no"), n_pages)
+                st.caption(f"共 {n_pages} 頁 / {len(final_display_list)} 項")
+            page_rows = final_display_list[(page_no - 1) * page_size: page_no * page_size]
+            with c_detail:
+                with st.expander("📅 MRP 模擬明細", expanded=False):
+                    if matrix is not None: st.info("分期矩陣模式不含逐筆明細，請切換為「逐筆明細」")
+                    else:
+                        sel_row = st.selectbox("選擇品項", range(len(page_rows)), format_func=lambda i: f"{page_rows[i]['items'][0]['p_no']} | {page_rows[i]['model']}", key="detail_row")
+                        if sel_row is not None and sel_row < len(page_rows):
+                            if page_rows[sel_row]['simulation_logs']: st.markdown(render_simulation_table(page_rows[sel_row]), unsafe_allow_html=True)
+                            else: st.info("此品項沒有任何需求或到貨")
+            with recorder.stage("render", rows_in=len(final_display_list)) as rec:
+                if matrix is not None: show_bucket_matrix(page_rows, matrix)
+                else: st.markdown(render_grouped_html_table(page_rows, netting['warehouses'], inline_simulation=False), unsafe_allow_html=True)
+                rec['rows_out'] = len(page_rows)
+        # 匯出目前篩選後的項目；檔案在按下下載時才逐列產生，不影響頁面重跑
+        with st.expander("⬇️ 匯出報表", expanded=False):
+            export_result = netting
+            available = ['shortage', 'groups'] + (['movements'] if matrix is None else ['buckets'])
+            c_fmt, c_tables = st.columns([1, 3])
+            with c_fmt: export_fmt = st.selectbox("格式", EXPORT_FORMATS, key="export_fmt")
+            with c_tables: export_keys = st.multiselect("內容", available, default=['shortage'] + (['buckets'] if matrix is not None else []), format_func=EXPORT_TABLES.get)
+            st.caption(f"共 {len(final_display_list)} 項 (依目前的篩選、搜尋與缺料切換)；xlsx 每個內容一頁，CSV / Parquet 每個內容一個檔")
+            if export_fmt == 'xlsx':
+                st.download_button("⬇️ 下載 xlsx", lambda: export_bytes(export_result, 'xlsx', export_keys, final_display_list), file_name="shortage_report.xlsx",
+                                   mime=EXPORT_MIMES['xlsx'], disabled=not export_keys)
+            else:
+                for key in export_keys:
+                    st.download_button(f"⬇️ {EXPORT_TABLES[key]} ({export_fmt})", lambda key=key: export_bytes(export_result, export_fmt, (key,), final_display_list),
+                                       file_name=f"shortage_{key}.{export_fmt}", mime=EXPORT_MIMES[export_fmt], key=f"export_{key}")
     else:
         if st.session_state.show_shortage_only: st.success("🎉 目前沒有任何缺料項目！")
         else:
             if active_models: st.info("查無符合條件的資料")
             else: st.info("💡 請在左側輸入排程，或選擇「全部顯示」查看所有 BOM。")
+
+    # 情境模擬：同一份主檔/到貨下比較多組排程，對整份 BOM 列出與現況不同的缺料項目
+    with st.expander("🧪 情境模擬 (What-if)", expanded=False):
+        st.caption("每列一筆追加插單；同一情境名稱的列合併為一個情境。可只填平移/忽略天數或勾選排除現有插單。")
+        scenario_rows = st.data_editor(
+            pd.DataFrame(columns=SCENARIO_COLUMNS).astype({"插單日期": "datetime64[ns]", "數量": "Int64", "MPS平移天數": "Int64", "忽略天數": "Int64", "排除現有插單": bool}),
+            num_rows="dynamic", hide_index=True, key="scenario_editor",
+            column_config={
+                "插單日期": st.column_config.DateColumn(format="YYYY-MM-DD"),
+                "型號": st.column_config.SelectboxColumn(options=unique_models),
+                "數量": st.column_config.NumberColumn(min_value=0, step=1),
+                "MPS平移天數": st.column_config.NumberColumn(step=1, help="負數為提前"),
+                "忽略天數": st.column_config.NumberColumn(min_value=0, step=1, help="空白則沿用左側設定"),
+            },
+        )
+        scenarios = scenarios_from_editor(scenario_rows)
+        if st.button("▶️ 執行情境比較", disabled=not scenarios):
+            # 整份 BOM 的現況推演也走結果快取 (「全部顯示」且無排程時即同一份)
+            full_key = result_key[:-2] + (None, None)
+            if full_key not in results:
+                _cache_put(results, full_key, run_netting(df_bom_sorted, bom_cols, master['stock_table'], all_plans, s_list, None, recorder, identity=master['identity']), RESULT_CACHE_SIZE)
+            mps_long = parsed_mps(mps_file)[0] if mps_file else None
+            with st.spinner(f"推演 {len(scenarios)} 個情境中..."):
+                _, summary, detail = run_scenarios(master, st.session_state.plan, mps_long, s_list, scenarios, ignore_days, baseline=results[full_key], recorder=recorder)
+            st.session_state.scenario_result = (result_key[:-1], summary, detail)
+        if st.session_state.get('scenario_result'):
+            scen_key, summary, detail = st.session_state.scenario_result
+            if scen_key != result_key[:-1]: st.warning("⚠️ 主檔、排程或到貨已變動，以下為先前的比較結果")
+            st.dataframe(summary, hide_index=True)
+            if detail.empty: st.info("各情境的缺料狀態與首個斷料日都與現況相同")
+            else: st.dataframe(detail, hide_index=True)
+            st.download_button("⬇️ 下載差異明細 (CSV)", detail.to_csv(index=False).encode('utf-8-sig'), file_name="scenario_diff.csv", mime="text/csv")
+
+# ==========================================
+# 效能診斷：本次執行各階段耗時，可匯出整個 session 的量測記錄
+# ==========================================
+st.session_state.stage_log = (st.session_state.stage_log + recorder.records)[-STAGE_LOG_SIZE:]
+with st.sidebar:
+    with st.expander("⏱️ 效能診斷", expanded=False):
+        # tracemalloc 為整個伺服器行程共用：開啟後持續記錄到關閉為止，數值包含同時執行的其他 session
+        st.checkbox("記錄記憶體 (整個行程，較慢)", key="trace_memory", on_change=lambda: start_memory_trace() if st.session_state.trace_memory else stop_memory_trace())
+        if recorder.records:
+            stage_df = pd.DataFrame(recorder.records)
+            cols = [c for c in ['stage', 'seconds', 'process_kb', 'process_peak_kb', 'rows_in', 'rows_out', 'cached', 'incremental'] if c in stage_df.columns]
+            st.dataframe(stage_df[cols], hide_index=True)
+            st.caption(f"本次合計 {stage_df['seconds'].sum():.3f} 秒" + ("；記憶體為階段結束時整個行程的用量與開始記錄以來的峰值 (KB)" if 'process_kb' in stage_df.columns else ""))
+        st.download_button("⬇️ 匯出 JSON Lines", records_to_jsonl(st.session_state.stage_log), file_name="stage_timings.jsonl", mime="application/x-ndjson")
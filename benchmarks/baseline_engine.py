@@ -0,0 +1,363 @@
+"""最初版本 Shortage_Hunter_Pro.py 的計算 (逐列讀取、逐筆建帳、逐群組推演)，供黃金輸出比對錄製快照。
+
+計算部分逐行照抄原頁面，只做了以下調整，讓它能在網頁之外執行：
+- st.session_state 換成區域變數，庫存改為回傳 dict 而非寫入模組層的 individual_w08 / individual_w26；
+- 「今天」可由 today 指定 (原本固定為 date.today())；
+- 篩選機種、搜尋品號/品名不設條件 (與黃金比對的情況相同)；
+- 結果補上新版引擎的欄位名稱 (stock_totals、warehouses…)，匯出沿用 shortage_engine 的寫檔函式。
+
+    python benchmarks/golden.py --record       # 錄製快照時預設使用本模組
+"""
+import io
+import os
+import sys
+import warnings
+from datetime import date, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 非計算部分 (預設檔名、階段計時、匯出、測試資料用的主檔快照) 與新版引擎共用
+from shortage_engine import FILES, StageRecorder, _sidecar_path, _stage, build_master_snapshot, export_bytes  # noqa: F401
+
+WAREHOUSES = ["W08", "W26"]
+
+# 原頁面的 process_stock 會對篩選後的切片賦值 (pandas 提示 SettingWithCopyWarning)，照抄保留，只關掉提示
+warnings.simplefilter("ignore", pd.errors.SettingWithCopyWarning)
+
+def get_base_part_no(raw_no):
+    s = str(raw_no).strip()
+    if len(s) > 0 and s[0] in '0123456789': s = "TW" + s
+    if '-' in s: return s.split('-')[0]
+    return s
+
+def normalize_key(part_no):
+    if pd.isna(part_no): return ""
+    s = str(part_no).upper().strip()
+    s = s.replace("TW", "").replace("-", "").replace(" ", "")
+    return s
+
+def read_excel_auto_header(file_path, read_errors):
+    if not os.path.exists(file_path): return pd.DataFrame()
+    try:
+        df_preview = pd.read_excel(file_path, header=None, nrows=10, engine='openpyxl')
+        target_row = 0
+        found = False
+        for idx, row in df_preview.iterrows():
+            row_str = " ".join(row.astype(str).values)
+            if "品號" in row_str: target_row = idx; found = True; break
+        return pd.read_excel(file_path, header=target_row, engine='openpyxl')
+    except Exception as e:
+        read_errors[file_path] = str(e)
+        return pd.DataFrame()
+
+def clean_df(df):
+    if df.empty: return df
+    df.columns = [str(c).strip() for c in df.columns]
+    part_col = next((c for c in df.columns if '品號' in c), None)
+    if part_col:
+        df = df.dropna(subset=[part_col])
+        df = df[~df[part_col].astype(str).str.contains('小計|合計|總計', na=False)]
+    return df
+
+def process_mps_file(uploaded_file, ignore_days=1, today=None):
+    mps_list = []
+    log_msg = []
+    try:
+        df = pd.read_excel(uploaded_file, engine='openpyxl')
+        date_col = next((c for c in df.columns if 'Date' in str(c) or '日期' in str(c)), None)
+        if not date_col: return [], ["❌ 找不到 [Date] 欄位"]
+
+        target_cols = []
+        for c in df.columns:
+            clean_c = str(c).replace('\n', '').replace(' ', '')
+            if '計畫' in clean_c and '產出' in clean_c:
+                model_name = clean_c.replace('計畫', '').replace('產出', '').strip()
+                if model_name: target_cols.append({'col': c, 'model': model_name})
+        if not target_cols: return [], ["⚠️ 找不到任何 [計畫產出] 欄位"]
+
+        today = today or date.today()
+        cutoff_date = today + timedelta(days=ignore_days)
+        count = 0
+        skip_count = 0
+
+        for _, row in df.iterrows():
+            try:
+                raw_date = row[date_col]
+                dt_obj = pd.to_datetime(raw_date)
+                if dt_obj.date() < cutoff_date:
+                    skip_count += 1
+                    continue
+                plan_date_str = dt_obj.strftime('%Y-%m-%d')
+                for t in target_cols:
+                    qty = row[t['col']]
+                    if pd.notna(qty):
+                        try:
+                            qty_val = float(qty)
+                            if qty_val > 0:
+                                mps_list.append({'日期': plan_date_str, '型號': t['model'], '數量': int(qty_val), 'source': 'MPS'})
+                                count += 1
+                        except: pass
+            except: continue
+        log_msg.append(f"✅ 匯入 {count} 筆 (已過濾 {cutoff_date.strftime('%m/%d')} 之前的舊資料)")
+        return mps_list, log_msg
+    except Exception as e:
+        return [], [f"❌ MPS 讀取失敗: {str(e)}"]
+
+def process_supplier_uploads(uploaded_files):
+    # uploaded_files 為 [(檔名, bytes)]
+    supply_list = []
+    log_msg = []
+    if not uploaded_files: return [], []
+    for name, data in uploaded_files:
+        try:
+            df_raw = pd.read_excel(io.BytesIO(data), header=None, engine='openpyxl')
+            header_row_idx = -1; part_col_idx = -1
+            for r in range(min(15, len(df_raw))):
+                row_vals = df_raw.iloc[r].astype(str).values
+                for c, val in enumerate(row_vals):
+                    if "品號" in val: header_row_idx = r; part_col_idx = c; break
+                if header_row_idx != -1: break
+            if header_row_idx == -1: log_msg.append(f"❌ {name}: 未偵測到品號欄"); continue
+            date_col_map = {}
+            scan_start = max(0, header_row_idx - 1)
+            scan_end = min(len(df_raw), header_row_idx + 6)
+            for r in range(scan_start, scan_end):
+                temp_map = {}
+                for c in range(len(df_raw.columns)):
+                    val = df_raw.iloc[r, c]
+                    try:
+                        dt = pd.to_datetime(val, errors='coerce')
+                        if pd.notna(dt): temp_map[c] = dt.strftime('%Y-%m-%d')
+                    except: continue
+                if temp_map: date_col_map = temp_map; break
+            if not date_col_map: log_msg.append(f"⚠️ {name}: 未偵測到日期欄"); continue
+            data_start_row = header_row_idx + 1
+            count = 0
+            for r in range(data_start_row, len(df_raw)):
+                try:
+                    p_no = str(df_raw.iloc[r, part_col_idx]).strip()
+                    if not p_no or p_no.lower() == 'nan': continue
+                    for c_idx, date_str in date_col_map.items():
+                        qty_val = df_raw.iloc[r, c_idx]
+                        try:
+                            qty = float(qty_val)
+                            if qty > 0:
+                                supply_list.append({'date': date_str, 'type': 'supply', 'note': "🚛 到貨", 'part_no': p_no, 'match_key': normalize_key(p_no), 'qty': qty})
+                                count += 1
+                        except: continue
+                except: continue
+            log_msg.append(f"✅ {name}: {count} 筆")
+        except Exception as e: log_msg.append(f"❌ {name}: {str(e)}")
+    return supply_list, log_msg
+
+def process_stock(df, store_type):
+    individual = {}
+    if df.empty: return individual
+    try:
+        candidates = [c for c in df.columns if '數量' in c]
+        stock_cols = [c for c in candidates if '庫存' in c]
+        col_q = stock_cols[0] if stock_cols else (candidates[0] if candidates else None)
+        if not col_q: return individual
+        col_p = next(c for c in df.columns if '品號' in c)
+        if store_type == 'W08':
+            col_wh = next((c for c in df.columns if '庫別' in c), None)
+            if col_wh: df = df[df[col_wh].astype(str).str.strip() == 'W08']
+        df[col_q] = pd.to_numeric(df[col_q], errors='coerce').fillna(0)
+        for _, row in df.iterrows():
+            raw_p = str(row[col_p]).strip()
+            stock_base = get_base_part_no(raw_p)
+            qty = row[col_q]
+            individual[stock_base] = individual.get(stock_base, 0) + qty
+    except: pass
+    return individual
+
+def sort_by_shortage_date(item):
+    if item['final_balance'] >= 0:
+        return "9999-99-99"
+    info = item.get('first_shortage_info', '-')
+    if info == '-': return "9999-99-99"
+    return info.split(' ')[0]
+
+def run_pipeline(files=FILES, stock_sources=None, manual_plans=(), mps_data=None, supplier_files=(), ignore_days=1, model=None, today=None, recorder=None, buckets=None):
+    """與 shortage_engine.run_pipeline 相同的參數與回傳值 (只支援預設的 W08/W26 庫存，不支援分期推演)。"""
+    if buckets is not None: raise ValueError("最初版本沒有分期推演")
+    read_errors, logs = {}, []
+    frames = {}
+    for key in ("bom", "stock_w08", "stock_w26"):
+        with _stage(recorder, f"load_data:{key}") as rec:
+            frames[key] = clean_df(read_excel_auto_header(files[key], read_errors))
+            rec['rows_out'] = len(frames[key])
+    if frames["stock_w26"].empty and files["stock_w26"] not in read_errors:
+        logs.append(f"⚠️ {files['stock_w26']} 內容為空或讀取失敗")
+    df_bom_src = frames["bom"]
+
+    c_model = next(c for c in df_bom_src.columns if '型號' in c)
+    c_part = next(c for c in df_bom_src.columns if '品號' in c)
+    c_code = next((c for c in df_bom_src.columns if '項目' in c or '代號' in c), None)
+    c_name = next((c for c in df_bom_src.columns if '品名' in c), None)
+    c_usage = next((c for c in df_bom_src.columns if '用量' in c), None)
+
+    if c_code:
+        df_bom_src[c_code] = df_bom_src[c_code].fillna('').astype(str)
+        df_bom_src['_sort_num'] = df_bom_src[c_code].str.extract(r'(\d+)').astype(float).fillna(0)
+        df_bom_sorted = df_bom_src.sort_values(by=[c_model, '_sort_num', c_part])
+    else:
+        df_bom_sorted = df_bom_src.sort_values(by=[c_model, c_part])
+
+    s_list, mps_data_list = [], []
+    if mps_data is not None:
+        with _stage(recorder, "mps_parse") as rec:
+            mps_data_list, mps_logs = process_mps_file(io.BytesIO(mps_data), ignore_days=ignore_days, today=today)
+            logs += mps_logs
+            rec['rows_out'] = len(mps_data_list)
+    with _stage(recorder, "supplier_parse", rows_in=len(supplier_files)) as rec:
+        s_list, s_logs = process_supplier_uploads(list(supplier_files))
+        logs += s_logs
+        rec['rows_out'] = len(s_list)
+
+    with _stage(recorder, "process_stock") as rec:
+        individual_w08 = process_stock(frames["stock_w08"], 'W08')
+        individual_w26 = process_stock(frames["stock_w26"], 'W26')
+
+    with _stage(recorder, "ledger_build") as rec:
+        ledger = {}
+        total_plan_qty = 0
+        active_models = []
+
+        all_plans = []
+        for p in manual_plans: p = dict(p); p['source'] = '手動'; all_plans.append(p)
+        if mps_data_list: all_plans.extend(mps_data_list)
+
+        if all_plans:
+            sorted_plan_data = sorted(all_plans, key=lambda x: x['日期'])
+            active_models = list(set([p['型號'] for p in sorted_plan_data]))
+            for item in sorted_plan_data:
+                plan_date, plan_model, plan_qty = item['日期'], item['型號'], item['數量']
+                source_note = "MPS" if item.get('source') == 'MPS' else "手動"
+                total_plan_qty += plan_qty
+                model_bom = df_bom_sorted[df_bom_sorted[c_model] == plan_model]
+                model_reqs = {}
+                for _, r in model_bom.iterrows():
+                    p_no = str(r[c_part]).strip()
+                    norm_k = normalize_key(p_no)
+                    try: usage = float(r.get(c_usage, 0))
+                    except: usage = 0
+                    if usage > model_reqs.get(norm_k, 0): model_reqs[norm_k] = usage
+                for k, u in model_reqs.items():
+                    if k not in ledger: ledger[k] = []
+                    ledger[k].append({'date': plan_date, 'type': 'demand', 'note': f"生產({source_note}): {plan_model}", 'qty': plan_qty * u})
+
+        normalized_map = {}
+        for k in ledger.keys():
+            norm_k = normalize_key(k)
+            if norm_k not in normalized_map: normalized_map[norm_k] = []
+            normalized_map[norm_k].append(k)
+
+        if s_list:
+            for s in s_list:
+                sup_norm_key = s['match_key']
+                if sup_norm_key in normalized_map:
+                    for target_key in normalized_map[sup_norm_key]:
+                        ledger[target_key].append(s)
+                else:
+                    if s['part_no'] not in ledger: ledger[s['part_no']] = []
+                    ledger[s['part_no']].append(s)
+        rec['rows_out'] = len(ledger)
+
+    with _stage(recorder, "consolidation") as rec:
+        if model is None: target_df = df_bom_sorted[df_bom_sorted[c_model].isin(active_models)] if active_models else df_bom_sorted
+        else: target_df = df_bom_sorted[df_bom_sorted[c_model] == model]
+
+        # ★★★ 修改核心：合併共用料 (Consolidate by Part) ★★★
+        consolidated_groups = {}
+
+        for _, row in target_df.iterrows():
+            p_no = str(row[c_part]).strip()
+            bom_base = get_base_part_no(p_no)
+            p_code = str(row.get(c_code, '')).strip()
+            model_name = row[c_model]
+
+            # 鍵值：如果有群組代碼就用代碼，否則用料號
+            key = p_code if (p_code and p_code.lower()!='nan') else p_no
+
+            my_w08 = individual_w08.get(bom_base, 0)
+            my_w26 = individual_w26.get(bom_base, 0)
+            item_data = {'p_no': p_no, 'base': bom_base, 'name': row.get(c_name, ''), 'usage': float(row.get(c_usage, 0)), 'w08': my_w08, 'w26': my_w26, 'net_stock': my_w08 + my_w26}
+
+            if key not in consolidated_groups:
+                consolidated_groups[key] = {
+                    'models': {model_name}, # 使用 Set 來自動去重型號
+                    'code': p_code,
+                    'items': [item_data],
+                    'req_key': key,
+                    'total_w08': my_w08,
+                    'total_w26': my_w26,
+                    'total_net': my_w08 + my_w26,
+                    'seen_parts': {bom_base}
+                }
+            else:
+                group = consolidated_groups[key]
+                group['models'].add(model_name)
+                if bom_base not in group['seen_parts']:
+                    group['items'].append(item_data)
+                    group['total_w08'] += my_w08
+                    group['total_w26'] += my_w26
+                    group['total_net'] += (my_w08 + my_w26)
+                    group['seen_parts'].add(bom_base)
+
+        grouped_data = list(consolidated_groups.values())
+        for g in grouped_data:
+            g['model'] = ", ".join(sorted(list(g['models'])))
+        rec['rows_out'] = len(grouped_data)
+
+    with _stage(recorder, "netting") as rec:
+        processed_list = []
+        for g in grouped_data:
+            running_balance = g['total_net']
+            total_demand = 0
+            first_shortage_info = "-"
+            simulation_logs = []
+            unique_demands = {}
+            supplies = []
+
+            processed_ledger_keys = set()
+            for item in g['items']:
+                k = normalize_key(item['p_no'])
+                if k in ledger and k not in processed_ledger_keys:
+                    processed_ledger_keys.add(k)
+                    for entry in ledger[k]:
+                        if entry['type'] == 'demand':
+                            d_key = (entry['date'], entry['note'])
+                            # ★★★ 關鍵修正：對於同一工單的群組料，取最大值而非累加 ★★★
+                            if d_key not in unique_demands: unique_demands[d_key] = entry['qty']
+                            else: unique_demands[d_key] = max(unique_demands[d_key], entry['qty'])
+                        else: supplies.append(entry)
+
+            movements = supplies + [{'date': k[0], 'note': k[1], 'type': 'demand', 'qty': v} for k, v in unique_demands.items()]
+            movements.sort(key=lambda x: x['date'])
+
+            for m in movements:
+                if m['type'] == 'demand':
+                    running_balance -= m['qty']
+                    if m['qty'] > 0: total_demand += m['qty']
+                    if running_balance < 0 and first_shortage_info == "-":
+                        first_shortage_info = f"{m['date']} ({m['note']})"
+                elif m['type'] == 'supply': running_balance += m['qty']
+                simulation_logs.append({'date': m['date'], 'note': m['note'], 'type': m['type'], 'qty': m['qty'], 'balance': running_balance})
+
+            g['total_demand'] = total_demand
+            g['final_balance'] = running_balance
+            g['first_shortage_info'] = first_shortage_info
+            g['simulation_logs'] = simulation_logs
+            processed_list.append(g)
+
+        processed_list.sort(key=sort_by_shortage_date)
+        rec['rows_out'] = sum(len(g['simulation_logs']) for g in processed_list)
+
+    # 新版引擎的欄位名稱 (黃金比對與匯出使用)
+    for g in processed_list:
+        g['stock_totals'] = {"W08": g['total_w08'], "W26": g['total_w26']}
+        for item in g['items']: item['stock'] = {"W08": item['w08'], "W26": item['w26']}
+    return {'groups': processed_list, 'warehouses': WAREHOUSES, 'total_plan_qty': total_plan_qty}, logs
@@ -0,0 +1,152 @@
+"""逐階段計時整條缺料分析流程，每個階段輸出一行 JSON (JSON Lines)。
+
+    python benchmarks/bench_pipeline.py                          # 預設規模，資料不存在時先產生
+    python benchmarks/bench_pipeline.py --models 5 --bom-lines 200 --stock-rows 5000 --suppliers 5 --out quick.jsonl
+    python benchmarks/bench_pipeline.py --baseline last.jsonl --tolerance 1.25   # 任一階段變慢超過 25% 即回傳 1
+
+每行欄位：stage, best_s, median_s, runs, rows_in, rows_out (讀檔階段另有 bytes，型別化讀取另有 frame_bytes/full_frame_bytes，需求帳另有 ledger_bytes，分期推演另有 matrix_bytes，繪製階段另有 html_chars)，
+以及共同的 run 資訊 (規模設定、版本、時間)。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import date
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import make_data
+from shortage_engine import (
+    STOCK_SOURCES, clean_df, read_excel_auto_header, read_excel_typed, load_clean_table, _sidecar_path, detect_bom_columns, sort_bom,
+    aggregate_stock, parse_supplier_files, parse_mps_workbook, mps_plan_lines, PartIdentity, build_model_requirements,
+    build_demand_ledger, attach_supplies, consolidate_groups, simulate_groups, sort_by_shortage_date, bucket_netting,
+    render_grouped_html_table,
+)
+
+def timed(fn, repeat):
+    """執行 repeat 次，回傳 (各次秒數, 最後一次結果)。"""
+    times, result = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return times, result
+
+def run_stages(files, repeat, ignore_days=1):
+    """依序量測每個階段；每個階段都用前一階段的輸出當輸入。產生 (stage, 秒數列表, rows_in, rows_out, 其他欄位)。"""
+    stock_files = {k: files[k] for k, _ in STOCK_SOURCES.values()}
+
+    # 主檔讀取：完整 Excel 解析 (含表頭偵測)、型別化讀取 (只留用到的欄位) 與 Parquet 快取命中三種情況；之後的階段使用型別化的結果
+    frames, kinds = {}, {"bom": "bom", **{k: "stock" for k in stock_files}}
+    for key, path in [("bom", files["bom"])] + list(stock_files.items()):
+        times, full = timed(lambda: clean_df(read_excel_auto_header(path)), repeat)
+        yield f"read_excel:{key}", times, None, len(full), {"bytes": os.path.getsize(path)}
+        times, frames[key] = timed(lambda: read_excel_typed(path, kinds[key]), repeat)
+        yield f"read_typed:{key}", times, None, len(frames[key]), {"bytes": os.path.getsize(path), "frame_bytes": int(frames[key].memory_usage(deep=True).sum()),
+                                                                  "full_frame_bytes": int(full.memory_usage(deep=True).sum())}
+    for key, path in [("bom", files["bom"])] + list(stock_files.items()):
+        if os.path.exists(_sidecar_path(path)): os.remove(_sidecar_path(path))
+        load_clean_table(path, kind=kinds[key])
+        times, _ = timed(lambda: load_clean_table(path, kind=kinds[key]), repeat)
+        yield f"read_sidecar:{key}", times, None, len(frames[key]), {"bytes": os.path.getsize(_sidecar_path(path))}
+
+    stock_frames = {k: frames[k] for k in stock_files}
+    times, (stock_table, _) = timed(lambda: aggregate_stock(stock_frames), repeat)
+    yield "process_stock", times, sum(len(df) for df in stock_frames.values()), len(stock_table), {}
+
+    blobs = []
+    for path in files["suppliers"]:
+        with open(path, "rb") as f: blobs.append(f.read())
+    times, parsed = timed(lambda: parse_supplier_files(blobs), repeat)
+    supplies = [s for rows, _, _ in parsed for s in rows]
+    yield "supplier_parse", times, len(blobs), len(supplies), {"bytes": sum(map(len, blobs))}
+
+    with open(files["mps"], "rb") as f: mps_data = f.read()
+    times, (long_df, err) = timed(lambda: parse_mps_workbook(mps_data), repeat)
+    if err: raise RuntimeError(err)
+    all_plans = mps_plan_lines(long_df, ignore_days)[0]
+    yield "mps_parse", times, None, len(all_plans), {"bytes": len(mps_data)}
+
+    bom_cols = detect_bom_columns(frames["bom"])
+    df_bom_sorted = sort_bom(frames["bom"], bom_cols)
+    c_model, c_part, _, _, c_usage = bom_cols
+    times, identity = timed(lambda: PartIdentity(df_bom_sorted, bom_cols, stock_table), repeat)
+    yield "part_identity", times, len(df_bom_sorted) + len(stock_table), len(identity.keys), {}
+    keys = identity.keys
+    def build_ledger():
+        model_reqs = build_model_requirements(df_bom_sorted, c_model, c_part, c_usage, keys)
+        return attach_supplies(build_demand_ledger(all_plans, model_reqs, keys), supplies, identity)
+    times, ledger = timed(build_ledger, repeat)
+    yield "ledger_build", times, len(all_plans) + len(supplies), len(ledger), {"ledger_bytes": ledger.nbytes, "part_keys": len(keys)}
+
+    times, groups = timed(lambda: consolidate_groups(df_bom_sorted, bom_cols, identity), repeat)
+    yield "consolidation", times, len(df_bom_sorted), len(groups), {}
+
+    times, ordered = timed(lambda: sorted(simulate_groups([dict(g) for g in groups], ledger, keys), key=sort_by_shortage_date), repeat)
+    yield "netting", times, len(ledger), sum(len(g['simulation_logs']) for g in ordered), {}
+    for freq in ("D", "W"):
+        times, matrix = timed(lambda: bucket_netting(groups, ledger, freq), repeat)
+        yield f"netting_buckets:{freq}", times, len(ledger), matrix.balance.size, {"matrix_bytes": matrix.balance.nbytes}
+
+    warehouses = list(stock_table.columns)
+    times, html = timed(lambda: render_grouped_html_table(ordered, warehouses), repeat)
+    yield "render_full", times, len(ordered), None, {"html_chars": len(html)}
+    times, html = timed(lambda: render_grouped_html_table(ordered[:100], warehouses, inline_simulation=False), repeat)
+    yield "render_page", times, min(100, len(ordered)), None, {"html_chars": len(html)}
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return {r["stage"]: r for r in map(json.loads, f) if r.get("stage")}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="缺料分析流程逐階段效能測試")
+    parser.add_argument("--data", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"), help="測試資料資料夾 (含 manifest.json)")
+    parser.add_argument("--regenerate", action="store_true", help="即使資料已存在也重新產生")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="結果另存為 JSON Lines 檔")
+    parser.add_argument("--baseline", help="與先前的結果比較 (比較 best_s)")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="best_s 超過基準的倍數即視為退步")
+    make_data.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    manifest_path = os.path.join(args.data, "manifest.json")
+    wanted = dict(models=args.models, bom_lines=args.bom_lines, stock_rows=args.stock_rows, w26_rows=args.w26_rows, mps_days=args.mps_days,
+                  suppliers=args.suppliers, supplier_parts=args.supplier_parts, supplier_dates=args.supplier_dates, seed=args.seed)
+    manifest = None
+    if os.path.exists(manifest_path) and not args.regenerate:
+        with open(manifest_path, encoding="utf-8") as f: manifest = json.load(f)
+        # 規模不同或 MPS 起始日已過 (舊資料會被 ignore_days 濾掉) 就重新產生
+        if {k: manifest["config"].get(k) for k in wanted} != wanted or manifest["config"].get("generated") != str(date.today()): manifest = None
+    if manifest is None:
+        print(f"產生測試資料 → {args.data}", file=sys.stderr)
+        make_data.generate(args.data, **wanted)
+        with open(manifest_path, encoding="utf-8") as f: manifest = json.load(f)
+
+    run_info = {"config": manifest["config"], "repeat": args.repeat, "python": platform.python_version(), "pandas": pd.__version__,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    records, regressions = [], []
+    for stage, times, rows_in, rows_out, extra in run_stages(manifest["files"], args.repeat):
+        rec = {"stage": stage, "best_s": round(min(times), 6), "median_s": round(statistics.median(times), 6), "runs": len(times),
+               "rows_in": rows_in, "rows_out": rows_out, **extra, **run_info}
+        if stage in baseline:
+            rec["baseline_s"] = baseline[stage]["best_s"]
+            if rec["best_s"] > baseline[stage]["best_s"] * args.tolerance: regressions.append(stage)
+        records.append(rec)
+        print(json.dumps(rec, ensure_ascii=False), flush=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for rec in records: f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if regressions:
+        print(f"效能退步 (> {args.tolerance}x)：{', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""黃金輸出比對：改寫引擎 (庫存彙總、需求帳、推演迴圈…) 前後，確認規劃人員看到的數字完全相同。
+
+以內附的 缺料預估.xlsx / 庫存明細表.xlsx / W26庫存明細表.xlsx，加上固定種子產生的 MPS 與供應商交期檔，
+跑數個情況 (無排程、MPS + 到貨、較長的 ignore_days、手動插單、單一型號、品名/項目代號有空白的 BOM、
+工作表範圍標記 (<dimension>) 錯誤的排程與交期檔)，把每個群組的
+品名、項目代號、total_net、stock_totals、total_demand、final_balance、first_shortage_info 與 MRP 明細 (含排序) 存成快照。
+每個情況先清掉 Parquet 快取再跑：第一次為冷讀取、之後為快取命中，兩者結果必須相同。
+各表也會匯出成 CSV / Parquet / xlsx，快照記錄列數與 CSV、Parquet 內容的摘要；上傳檔的讀取列數另與 pd.read_excel 核對。
+快照由 baseline_engine (最初版本網頁的逐列/逐群組計算) 錄製，比對時逐群組列出差異 (有差異回傳 1)，
+同時列出各階段相對於快照記錄時的加速倍數 (同一台機器上才有意義)。
+刻意改變的行為列在 INTENDED_CHANGES：符合其規則的群組差異只列出、不算失敗，快照本身不含這些改變。
+
+    python benchmarks/golden.py --record                       # 以最初版本的計算 (baseline_engine) 產生/更新快照
+    python benchmarks/golden.py                                # 比對目前的引擎並報告各階段耗時
+    python benchmarks/golden.py --engine my_fast_engine        # 比對另一個實作 (需提供相同的 run_pipeline / StageRecorder)
+"""
+import argparse
+import hashlib
+import importlib
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import date, timedelta
+
+import pandas as pd
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import make_data
+
+SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "snapshot.json")
+TODAY = date(2026, 3, 2)  # 固定「今天」，ignore_days 的截止日才不會隨執行日期變動
+SEED = 11
+
+# 每個情況：手動插單、是否使用 MPS 與交期檔 (True，或 write_fixtures 產生的其他檔案鍵)、ignore_days、指定型號
+CASES = {
+    "bom_only": dict(),
+    "mps_supply": dict(mps=True, suppliers=True),
+    "mps_ignore_7": dict(mps=True, suppliers=True, ignore_days=7),
+    "manual": dict(manual=[
+        {"日期": "2026-03-04", "型號": "2450B", "數量": 300},
+        {"日期": "2026-03-04", "型號": "2450B-UL", "數量": 120},
+        {"日期": "2026-03-04", "型號": "2450B", "數量": 50},
+        {"日期": "2026-03-20", "型號": "2450H", "數量": 80},
+    ], suppliers=True),
+    "model_2450B": dict(mps=True, suppliers=True, model="2450B"),
+    "blank_cells": dict(bom="bom_blank", mps=True, suppliers=True),
+    "stale_dimension": dict(mps="mps_stale", suppliers="suppliers_stale"),
+}
+
+def write_stale_dimension(src, dst, ref="A1:B2"):
+    """複製 xlsx，但把工作表記錄的 <dimension> 改成 ref (比實際資料小，模擬部分系統匯出的檔案)。"""
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            data = zin.read(item.filename)
+            if item.filename.startswith("xl/worksheets/sheet"):
+                xml = re.sub(r"<dimension [^>]*/>", "", data.decode("utf-8"))
+                data = re.sub(r"(<sheetViews|<sheetFormatPr|<sheetData)", f'<dimension ref="{ref}" />\\1', xml, count=1).encode("utf-8")
+            zout.writestr(item, data)
+
+def write_fixtures(out, master):
+    """把內附主檔複製到 out，並依主檔的型號/料號產生 MPS 與供應商交期檔；回傳檔案對照。"""
+    files = {}
+    for key, name in master.FILES.items():
+        files[key] = os.path.join(out, name)
+        shutil.copy(os.path.join(ROOT, name), files[key])
+    snap = master.build_master_snapshot(files)
+    models = snap["unique_models"]
+    parts = sorted({str(p).strip() for p in snap["df_bom_sorted"][snap["bom_cols"][1]].tolist()})
+    # 交期檔的品號一半去掉 TW 前綴 (supplier_rows 會再隨機補回)，另加幾個 BOM 沒有的品號
+    pool = [p[2:] if p.startswith("TW") and i % 2 else p for i, p in enumerate(parts)] + ["99999999-01", "4010-XX"]
+    rng = random.Random(SEED)
+    start = TODAY - timedelta(days=3)  # 前幾天的排程會被 ignore_days 濾掉
+    files["mps"] = os.path.join(out, "mps.xlsx")
+    make_data.write_rows(files["mps"], make_data.mps_rows(models, 30, rng, start))
+    # 部分列的品名、項目代號清成空白 (冷讀取與快取命中時空白值要一致)
+    files["bom_blank"] = os.path.join(out, "bom_blank.xlsx")
+    wb = load_workbook(files["bom"])
+    ws = wb.worksheets[0]
+    rows = list(ws.iter_rows())
+    header = next(i for i, row in enumerate(rows) if any("品號" in str(c.value) for c in row))
+    blank_cols = [c.column for c in rows[header] if c.value is not None and ("品名" in str(c.value) or "項目" in str(c.value))]
+    for row in rows[header + 1::5]:
+        for c in row:
+            if c.column in blank_cols: c.value = None
+    wb.save(files["bom_blank"])
+    files["suppliers"] = []
+    for n in range(3):
+        path = os.path.join(out, f"sup_{n}.xlsx")
+        make_data.write_rows(path, make_data.supplier_rows(pool, 40, 6, rng, start, 30))
+        files["suppliers"].append(path)
+    files["mps_stale"] = os.path.join(out, "mps_stale.xlsx")
+    write_stale_dimension(files["mps"], files["mps_stale"])
+    files["suppliers_stale"] = []
+    for path in files["suppliers"]:
+        files["suppliers_stale"].append(path[:-5] + "_stale.xlsx")
+        write_stale_dimension(path, files["suppliers_stale"][-1])
+    return files
+
+def _filled_shape(df):
+    # 有內容的列數、欄數 (不計結尾的空白列/欄)
+    filled = df.notna().to_numpy()
+    return int(filled.any(axis=1).sum()), int(filled.any(axis=0).sum())
+
+def check_upload_reads(engine, files):
+    """上傳檔 (排程、交期) 經 engine.read_first_sheet 讀到的列數/欄數須與 pd.read_excel 相同 → 差異說明列表。"""
+    if not hasattr(engine, "read_first_sheet"): return []
+    problems = []
+    for path in [files["mps"], files["mps_stale"], *files["suppliers"], *files["suppliers_stale"]]:
+        with open(path, "rb") as f: got = _filled_shape(engine.read_first_sheet(f.read()))
+        want = _filled_shape(pd.read_excel(path, header=None, engine="openpyxl"))
+        if got != want: problems.append(f"{os.path.basename(path)}: 讀到 {got[0]}×{got[1]}，pd.read_excel 為 {want[0]}×{want[1]}")
+    return problems
+
+def group_snapshot(g):
+    return {
+        "req_key": str(g["req_key"]),
+        "model": g["model"],
+        "parts": [item["p_no"] for item in g["items"]],
+        "names": [str(item["name"]) for item in g["items"]],
+        "code": str(g["code"]),
+        "stock_totals": {wh: float(q) for wh, q in g["stock_totals"].items()},
+        "total_net": float(g["total_net"]),
+        "total_demand": float(g["total_demand"]),
+        "final_balance": float(g["final_balance"]),
+        "first_shortage_info": g["first_shortage_info"],
+        "logs": [[m["date"], m["note"], m["type"], float(m["qty"]), float(m["balance"])] for m in g["simulation_logs"]],
+    }
+
+EXPORT_KEYS = ("shortage", "groups", "movements", "unresolved_supplies", "unresolved_models")
+
+def _digest(data): return hashlib.sha256(data).hexdigest()[:16]
+
+def export_snapshot(engine, result):
+    """各表匯出成 CSV 與 Parquet → {表鍵: [列數, CSV 摘要, Parquet 內容摘要]}；xlsx 只確認能寫出。
+    結果中沒有的表 (最初版本沒有 unresolved_*) 略過。"""
+    out = {}
+    keys = [key for key in EXPORT_KEYS if not key.startswith("unresolved_") or result.get(key) is not None]
+    for key in keys:
+        table = pq.read_table(io.BytesIO(engine.export_bytes(result, "parquet", (key,))))
+        content = json.dumps(table.to_pydict(), ensure_ascii=False, default=str).encode("utf-8")
+        out[key] = [table.num_rows, _digest(engine.export_bytes(result, "csv", (key,))), _digest(content)]
+    engine.export_bytes(result, "xlsx", keys)
+    return out
+
+def run_cases(engine, files, repeat, tol):
+    """每個情況跑 repeat 次 (至少 2 次) → ({情況: 輸出}, {情況: {階段: 最佳秒數}}, {情況: 冷/熱快取差異})。
+    每個情況開始前先刪除 Parquet 快取，第一次為冷讀取，之後的結果都要與第一次相同。"""
+    mps_data = {}
+    for key in ("mps", "mps_stale"):
+        with open(files[key], "rb") as f: mps_data[key] = f.read()
+    supplier_files = {}
+    for key in ("suppliers", "suppliers_stale"):
+        supplier_files[key] = []
+        for path in files[key]:
+            with open(path, "rb") as f: supplier_files[key].append((os.path.basename(path), f.read()))
+    outputs, timings, unstable = {}, {}, {}
+    for name, case in CASES.items():
+        master_files = {k: files[case.get(k, k)] for k in engine.FILES}
+        for path in master_files.values():
+            if os.path.exists(engine._sidecar_path(path)): os.remove(engine._sidecar_path(path))
+        # True 為一般的排程/交期檔，字串為 files 中的其他鍵
+        mps_key = "mps" if case.get("mps") is True else case.get("mps")
+        sup_key = "suppliers" if case.get("suppliers") is True else case.get("suppliers")
+        best, first = {}, None
+        for _ in range(max(2, repeat)):
+            recorder = engine.StageRecorder()
+            result, _ = engine.run_pipeline(master_files, manual_plans=case.get("manual", []), mps_data=mps_data.get(mps_key),
+                                            supplier_files=supplier_files.get(sup_key, []), ignore_days=case.get("ignore_days", 1),
+                                            model=case.get("model"), today=TODAY, recorder=recorder)
+            for rec in recorder.records: best[rec["stage"]] = min(best.get(rec["stage"], math.inf), rec["seconds"])
+            output = {"total_plan_qty": float(result["total_plan_qty"]), "groups": [group_snapshot(g) for g in result["groups"]],
+                      "exports": export_snapshot(engine, result)}
+            if first is None: first = output
+            elif name not in unstable: unstable[name] = diff_case(first, output, tol)
+        outputs[name], timings[name] = first, best
+    return outputs, timings, {k: v for k, v in unstable.items() if v}
+
+def _close(a, b, tol):
+    if isinstance(a, float) and isinstance(b, float): return math.isclose(a, b, rel_tol=tol, abs_tol=tol)
+    return a == b
+
+def diff_case(expected, actual, tol, limit=10):
+    """回傳差異說明列表 (最多 limit 筆)。群組依 parts 對應；順序不同也算差異。"""
+    problems = []
+    if not _close(expected["total_plan_qty"], actual["total_plan_qty"], tol):
+        problems.append(f"total_plan_qty: {expected['total_plan_qty']} → {actual['total_plan_qty']}")
+    exp_groups = {tuple(g["parts"]): g for g in expected["groups"]}
+    act_groups = {tuple(g["parts"]): g for g in actual["groups"]}
+    for parts in exp_groups.keys() - act_groups.keys(): problems.append(f"缺少群組 {' / '.join(parts)}")
+    for parts in act_groups.keys() - exp_groups.keys(): problems.append(f"多出群組 {' / '.join(parts)}")
+    for parts in exp_groups.keys() & act_groups.keys():
+        e, a = exp_groups[parts], act_groups[parts]
+        label = " / ".join(parts)
+        for field in ("req_key", "model", "code", "names", "total_net", "total_demand", "final_balance", "first_shortage_info"):
+            if not _close(e[field], a[field], tol): problems.append(f"{label} {field}: {e[field]!r} → {a[field]!r}")
+        if e["stock_totals"].keys() != a["stock_totals"].keys() or not all(_close(q, a["stock_totals"][wh], tol) for wh, q in e["stock_totals"].items()):
+            problems.append(f"{label} stock_totals: {e['stock_totals']} → {a['stock_totals']}")
+        if len(e["logs"]) != len(a["logs"]): problems.append(f"{label} MRP 明細筆數: {len(e['logs'])} → {len(a['logs'])}")
+        else:
+            for i, (le, la) in enumerate(zip(e["logs"], a["logs"])):
+                if not all(_close(x, y, tol) for x, y in zip(le, la)):
+                    problems.append(f"{label} MRP 明細第 {i + 1} 筆: {le} → {la}"); break
+    for key, value in expected.get("exports", {}).items():
+        if actual.get("exports", {}).get(key) != value: problems.append(f"匯出 {key} (列數, CSV, Parquet): {value} → {actual.get('exports', {}).get(key)}")
+    if not problems and [tuple(g["parts"]) for g in expected["groups"]] != [tuple(g["parts"]) for g in actual["groups"]]:
+        problems.append("群組排序 (首個斷料日) 不同")
+    problems.sort()
+    return problems[:limit] + ([f"… 另有 {len(problems) - limit} 筆差異"] if len(problems) > limit else [])
+
+def _demand_free(logs): return all(log[2] != "demand" for log in logs)
+
+def _supplies_reach_idle_parts(e, a, tol):
+    # 兩邊都沒有需求、其他欄位相同，最初版本的到貨是目前到貨的子集，且目前的結餘 = 庫存 + 全部到貨
+    if not (_demand_free(e["logs"]) and _demand_free(a["logs"])): return False
+    if any(not _close(e[f], a[f], tol) for f in ("req_key", "model", "code", "names", "total_net", "total_demand", "first_shortage_info")): return False
+    remaining = [(log[0], log[1], log[3]) for log in a["logs"]]
+    for log in e["logs"]:
+        if (log[0], log[1], log[3]) not in remaining: return False
+        remaining.remove((log[0], log[1], log[3]))
+    return _close(a["final_balance"], a["total_net"] + sum(log[3] for log in a["logs"]), tol)
+
+# 相對於最初版本刻意改變的行為：需求單號 → (說明, 規則 (快照群組, 目前群組, 容許誤差) → 是否屬於此改變, 受影響的匯出表)
+INTENDED_CHANGES = {
+    "user-019": ("到貨也會併入本次沒有需求的 BOM 料號 (最初版本只併入有需求的料號，其餘到貨不計)",
+                 _supplies_reach_idle_parts, ("shortage", "movements")),
+}
+
+def apply_intended_changes(expected, actual, tol):
+    """快照中符合 INTENDED_CHANGES 的群組換成目前的結果 (受影響的匯出表不比對摘要) → (調整後的快照, {需求單號: [群組]})。"""
+    act_groups = {tuple(g["parts"]): g for g in actual["groups"]}
+    groups, matched, skip_exports = [], {}, set()
+    for e in expected["groups"]:
+        a = act_groups.get(tuple(e["parts"]))
+        change = None
+        if a is not None and diff_case({"total_plan_qty": 0.0, "groups": [e]}, {"total_plan_qty": 0.0, "groups": [a]}, tol):
+            change = next((cid for cid, (_, rule, _) in INTENDED_CHANGES.items() if rule(e, a, tol)), None)
+        if change is None: groups.append(e); continue
+        groups.append(a)
+        matched.setdefault(change, []).append(" / ".join(e["parts"]))
+        skip_exports.update(INTENDED_CHANGES[change][2])
+    exports = {k: v for k, v in expected.get("exports", {}).items() if k not in skip_exports}
+    return dict(expected, groups=groups, exports=exports), matched
+
+def speedup_rows(recorded, current):
+    """各情況、各階段 → (情況, 階段, 快照秒數, 目前秒數, 加速倍數)。"""
+    for case, stages in current.items():
+        for stage, seconds in stages.items():
+            before = recorded.get(case, {}).get(stage)
+            yield case, stage, before, seconds, (before / seconds if before and seconds else None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="缺料推演黃金輸出比對")
+    parser.add_argument("--record", action="store_true", help="以 --engine (預設為最初版本的 baseline_engine) 產生/更新快照")
+    parser.add_argument("--snapshot", default=SNAPSHOT)
+    parser.add_argument("--engine", default=None, help="要執行的引擎模組 (比對時預設 shortage_engine，錄製時預設 baseline_engine)")
+    parser.add_argument("--repeat", type=int, default=3, help="每個情況執行次數 (至少 2 次，耗時取最佳)")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="數值比對的相對/絕對容許誤差")
+    args = parser.parse_args(argv)
+
+    args.engine = args.engine or ("baseline_engine" if args.record else "shortage_engine")
+    engine = importlib.import_module(args.engine)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = write_fixtures(tmp, engine)
+        read_problems = check_upload_reads(engine, files)
+        outputs, timings, unstable = run_cases(engine, files, args.repeat, args.tolerance)
+    for p in read_problems: print(f"❌ 上傳檔讀取不完整 {p}")
+    for name, problems in unstable.items():
+        print(f"❌ {name}: 冷讀取與快取命中的結果不同")
+        for p in problems: print(f"    {p}")
+
+    if args.record:
+        if unstable or read_problems: return 1
+        os.makedirs(os.path.dirname(args.snapshot), exist_ok=True)
+        with open(args.snapshot, "w", encoding="utf-8") as f:
+            json.dump({"today": str(TODAY), "seed": SEED, "recorded": time.strftime("%Y-%m-%dT%H:%M:%S"), "engine": args.engine,
+                       "timings": timings, "cases": outputs}, f, ensure_ascii=False, separators=(",", ":"))
+        print(f"快照已寫入 {args.snapshot} ({sum(len(o['groups']) for o in outputs.values())} 個群組)")
+        return 0
+
+    with open(args.snapshot, encoding="utf-8") as f: snapshot = json.load(f)
+    failed = bool(unstable or read_problems)
+    for name, expected in snapshot["cases"].items():
+        if name not in outputs: problems, matched = ["目前的 CASES 沒有此情況"], {}
+        else:
+            expected, matched = apply_intended_changes(expected, outputs[name], args.tolerance)
+            problems = diff_case(expected, outputs[name], args.tolerance)
+        print(f"{'✅' if not problems else '❌'} {name}: {len(expected['groups'])} 個群組")
+        for p in problems: print(f"    {p}")
+        for change, parts in matched.items():
+            print(f"    ℹ️ {change} 預期差異 ({INTENDED_CHANGES[change][0]})：{len(parts)} 個群組，如 {parts[0]}")
+        failed |= bool(problems)
+    print(f"\n{'情況':<16}{'階段':<24}{'快照(s)':>10}{'目前(s)':>10}{'加速':>8}")
+    for case, stage, before, now, ratio in speedup_rows(snapshot["timings"], timings):
+        print(f"{case:<16}{stage:<24}{'-' if before is None else f'{before:.4f}':>10}{now:>10.4f}{'-' if ratio is None else f'{ratio:.2f}x':>8}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
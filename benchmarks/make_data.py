@@ -0,0 +1,125 @@
+"""產生壓力測試用的假資料：BOM、W08/W26 庫存、MPS 排程與供應商交期表，版面與實際檔案相同。
+
+    python benchmarks/make_data.py --out benchmarks/data --models 50 --bom-lines 2000 \
+        --stock-rows 200000 --mps-days 365 --suppliers 50
+"""
+import argparse
+import json
+import os
+import random
+from datetime import date, datetime, timedelta
+
+from openpyxl import Workbook
+
+WAREHOUSE_CODES = ["W08", "W01", "W09", "W10", "W11", "W12"]
+NAMES = ["電池管理系統採樣板", "分壓線束", "尼龍線扣", "銅排", "保險絲", "端子台", "散熱片", "風扇電源板"]
+
+def write_rows(path, rows):
+    # write-only 模式逐列寫出，大表也不會整張留在記憶體
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for row in rows: ws.append(row)
+    wb.save(path)
+
+def part_pool(n_parts, rng):
+    parts = []
+    for i in range(n_parts):
+        prefix = rng.choice(["401", "402", "304", "501"])
+        parts.append(f"{prefix}{i:05d}-{rng.choice(['A0', '01', '02'])}")
+    return parts
+
+def bom_rows(models, parts, lines_per_model, rng):
+    # 前兩列空白 (標題區)，第三列為表頭；約三成的列帶項目代號，同代號的料件合併成共用料群組
+    yield []
+    yield [None, "缺料預估"]
+    yield ["型號", "品號", "品名", "規格", "組成用量", "W08庫存", "W26儲電倉", "項目代號"]
+    for m in models:
+        for i in range(lines_per_model):
+            usage = rng.choice([1, 1, 1, 2, 4, 6, 0.5, 0.023, 16])
+            yield [m, "TW" + rng.choice(parts), rng.choice(NAMES), f"SPEC-{i}", usage, 0, 0, f"C{i // 3 + 1}" if i % 10 < 3 else None]
+
+def stock_w08_rows(parts, n_rows, rng):
+    # 三列標題 (公司/表名/製表日期) 後才是表頭；夾雜小計列
+    yield [None] * 7 + ["儲盈電池製造股份有限公司"]
+    yield [None] * 7 + ["庫存明細表"]
+    yield [f"製表日期: {date.today():%Y/%m/%d}"] + [None] * 14
+    yield ["品號", "品名", "規格", "單位", "包裝單位", "庫別", "庫別名稱", "庫存數量", "庫存金額", "單位成本", "庫存包裝數量", "材料金額", "人工金額", "製費金額", "加工金額"]
+    for i in range(n_rows):
+        if i % 50 == 49:
+            yield [None] * 5 + ["小計:", None, rng.randint(0, 5000)] + [None] * 7
+            continue
+        qty = rng.randint(0, 3000)
+        yield [rng.choice(parts), rng.choice(NAMES), "SPEC", "PCS", None, rng.choice(WAREHOUSE_CODES), "倉", qty, qty * 10, 10, 0, qty * 10, 0, 0, 0]
+
+def stock_w26_rows(parts, n_rows, rng):
+    yield ["品號", "品名", "規格", "庫存數量", "單位", "庫別", "庫別名稱"]
+    for _ in range(n_rows):
+        yield [rng.choice(parts), rng.choice(NAMES), "SPEC", rng.randint(0, 500), "PCS", None, None]
+
+def mps_rows(models, n_days, rng, start):
+    yield ["Date"] + [f"{m}\n計畫產出" for m in models] + ["備註"]
+    for d in range(n_days):
+        day = datetime.combine(start + timedelta(days=d), datetime.min.time())
+        yield [day] + [rng.choice([None, 0, 10, 20, 50, 100]) for _ in models] + [None]
+
+def supplier_rows(parts, n_parts, n_dates, rng, start, horizon):
+    # 標題一列，表頭列放品號/品名與各到貨日期
+    dates = sorted({datetime.combine(start + timedelta(days=rng.randint(0, horizon)), datetime.min.time()) for _ in range(n_dates)})
+    yield ["供應商交期表"]
+    yield ["品號", "品名"] + dates
+    for p in rng.sample(parts, min(n_parts, len(parts))):
+        yield [p if rng.random() < .5 else "TW" + p, rng.choice(NAMES)] + [rng.choice([None, None, 0, 30, 100, 500]) for _ in dates]
+    yield ["小計", None, 1]
+
+def generate(out, models=50, bom_lines=2000, stock_rows=200_000, w26_rows=20_000, mps_days=365, suppliers=50,
+             supplier_parts=300, supplier_dates=12, parts=None, seed=7):
+    """寫出整組假資料並回傳檔案對照 (也存成 out/manifest.json)。"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(out, "suppliers"), exist_ok=True)
+    model_names = [f"M{i:03d}" for i in range(models)]
+    pool = part_pool(parts or max(500, bom_lines * 2), rng)
+    start = date.today()
+    files = {
+        "bom": os.path.join(out, "bom.xlsx"),
+        "stock_w08": os.path.join(out, "stock_w08.xlsx"),
+        "stock_w26": os.path.join(out, "stock_w26.xlsx"),
+        "mps": os.path.join(out, "mps.xlsx"),
+    }
+    write_rows(files["bom"], bom_rows(model_names, pool, bom_lines, rng))
+    write_rows(files["stock_w08"], stock_w08_rows(pool, stock_rows, rng))
+    write_rows(files["stock_w26"], stock_w26_rows(pool, w26_rows, rng))
+    write_rows(files["mps"], mps_rows(model_names, mps_days, rng, start))
+    files["suppliers"] = []
+    for n in range(suppliers):
+        path = os.path.join(out, "suppliers", f"sup_{n:03d}.xlsx")
+        write_rows(path, supplier_rows(pool, supplier_parts, supplier_dates, rng, start, mps_days))
+        files["suppliers"].append(path)
+
+    config = dict(models=models, bom_lines=bom_lines, stock_rows=stock_rows, w26_rows=w26_rows, mps_days=mps_days,
+                  suppliers=suppliers, supplier_parts=supplier_parts, supplier_dates=supplier_dates, seed=seed, generated=str(start))
+    with open(os.path.join(out, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"config": config, "files": files}, f, ensure_ascii=False, indent=1)
+    return files
+
+def add_arguments(parser):
+    parser.add_argument("--models", type=int, default=50)
+    parser.add_argument("--bom-lines", type=int, default=2000, help="每個型號的 BOM 列數")
+    parser.add_argument("--stock-rows", type=int, default=200_000, help="W08 庫存表列數")
+    parser.add_argument("--w26-rows", type=int, default=20_000, help="W26 庫存表列數")
+    parser.add_argument("--mps-days", type=int, default=365)
+    parser.add_argument("--suppliers", type=int, default=50, help="供應商交期檔數")
+    parser.add_argument("--supplier-parts", type=int, default=300, help="每個交期檔的料號數")
+    parser.add_argument("--supplier-dates", type=int, default=12, help="每個交期檔的日期欄數")
+    parser.add_argument("--seed", type=int, default=7)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="產生缺料分析壓力測試資料")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(__file__), "data"))
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    generate(args.out, args.models, args.bom_lines, args.stock_rows, args.w26_rows, args.mps_days, args.suppliers,
+             args.supplier_parts, args.supplier_dates, seed=args.seed)
+    print(f"資料已寫入 {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""手動插單的 SQLite 存檔：每筆插單有固定 id，新增/刪除只寫該筆，多人同時使用不會互相覆蓋。
+
+WAL 模式下讀取不會擋住寫入；version() 每次寫入遞增，各 session 只在版本變動時重新讀取。
+schedule.json 仍可作為匯入/匯出格式 (第一次建立資料庫時會自動匯入舊檔；舊檔有誤時保留待匯入狀態，下次啟動再試)。
+"""
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import pandas as pd
+
+PLAN_DB = "schedule.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plan_lines (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    added_at TEXT NOT NULL,
+    deleted_at TEXT
+);
+CREATE INDEX IF NOT EXISTS plan_lines_active ON plan_lines (deleted_at);
+CREATE TABLE IF NOT EXISTS plan_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL);
+INSERT OR IGNORE INTO plan_version VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS plan_meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def _now(): return datetime.now().isoformat(timespec='seconds')
+
+def normalize_plan_lines(lines):
+    """檢查並整理 schedule.json 格式的插單：日期統一為 YYYY-MM-DD、數量為整數。
+    任何一筆的日期或數量不合法時整批拋出 ValueError (不會只匯入一部分)。"""
+    if not isinstance(lines, list): raise ValueError("內容應為插單列表")
+    days = pd.to_datetime(pd.Series([p['日期'] for p in lines], dtype=object), errors='coerce', format='mixed')
+    result = []
+    for n, (p, day) in enumerate(zip(lines, days), 1):
+        if pd.isna(day): raise ValueError(f"第 {n} 筆日期無法辨識: {p['日期']!r}")
+        qty = pd.to_numeric(p['數量'], errors='coerce')
+        if isinstance(qty, bool) or pd.isna(qty) or qty != int(qty): raise ValueError(f"第 {n} 筆數量不是整數: {p['數量']!r}")
+        result.append({**p, '日期': day.strftime('%Y-%m-%d'), '型號': str(p['型號']).strip(), '數量': int(qty)})
+    return result
+
+class PlanStore:
+    """插單存檔。刪除只標記 deleted_at (保留歷史)；lines() 依新增順序回傳仍有效的插單。
+    legacy_error 為舊 schedule.json 匯入失敗的原因 (None 表示沒有錯誤)。"""
+    def __init__(self, path=PLAN_DB, legacy_json=None):
+        self.path = path
+        self.legacy_error = None
+        new_db = not os.path.exists(path)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            if new_db and legacy_json and os.path.exists(legacy_json):
+                conn.execute("INSERT OR IGNORE INTO plan_meta VALUES ('legacy_pending', ?)", (legacy_json,))
+        self.import_legacy()
+
+    def _connect(self):
+        # 每次操作各開一個連線，可在 Streamlit 的多個執行緒間安全使用
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def version(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT version FROM plan_version").fetchone()[0]
+
+    def lines(self):
+        """仍有效的插單 [{'id', '日期', '型號', '數量'}]，依新增順序。"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, day, model, qty FROM plan_lines WHERE deleted_at IS NULL ORDER BY id").fetchall()
+        return [{'id': i, '日期': d, '型號': m, '數量': q} for i, d, m, q in rows]
+
+    def snapshot(self):
+        """(版本, 插單) 在同一個讀取交易中取得，兩者一定一致。"""
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            version = conn.execute("SELECT version FROM plan_version").fetchone()[0]
+            rows = conn.execute("SELECT id, day, model, qty FROM plan_lines WHERE deleted_at IS NULL ORDER BY id").fetchall()
+            conn.execute("COMMIT")
+        return version, [{'id': i, '日期': d, '型號': m, '數量': q} for i, d, m, q in rows]
+
+    def changed_since(self, version):
+        """版本未變時回傳 (version, None)，否則回傳 (新版本, 插單)。"""
+        current = self.version()
+        if current == version: return current, None
+        return self.snapshot()
+
+    def _write(self, statements):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                changed = sum(conn.execute(sql, args).rowcount for sql, args in statements)
+                if changed: conn.execute("UPDATE plan_version SET version = version + 1")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK"); raise
+        return changed
+
+    def add(self, day, model, qty):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                plan_id = conn.execute("INSERT INTO plan_lines (day, model, qty, added_at) VALUES (?, ?, ?, ?)", (day, model, int(qty), _now())).lastrowid
+                conn.execute("UPDATE plan_version SET version = version + 1")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK"); raise
+        return plan_id
+
+    def delete(self, plan_id):
+        """刪除單筆；已被別人刪除時回傳 False。"""
+        return self._write([("UPDATE plan_lines SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL", (_now(), plan_id))]) > 0
+
+    def clear(self):
+        return self._write([("UPDATE plan_lines SET deleted_at = ? WHERE deleted_at IS NULL", (_now(),))])
+
+    def _import_statements(self, source, replace):
+        if isinstance(source, str):
+            with open(source, 'r', encoding='utf-8') as f: source = json.load(f)
+        source = normalize_plan_lines(source)
+        now = _now()
+        statements = [("UPDATE plan_lines SET deleted_at = ? WHERE deleted_at IS NULL", (now,))] if replace else []
+        statements += [("INSERT INTO plan_lines (day, model, qty, added_at) VALUES (?, ?, ?, ?)", (p['日期'], p['型號'], p['數量'], now)) for p in source]
+        return statements, len(source)
+
+    def import_json(self, source, replace=True):
+        """匯入 schedule.json 格式 (路徑或已載入的 list)；replace=True 時先清除現有插單。回傳匯入筆數。
+        內容有誤時拋出 ValueError / KeyError / TypeError，存檔不變。"""
+        statements, count = self._import_statements(source, replace)
+        self._write(statements)
+        return count
+
+    def import_legacy(self):
+        """匯入資料庫建立時排入的舊 schedule.json；成功時與清除待匯入狀態在同一個交易中完成。
+        失敗時不拋出例外：原因記在 legacy_error，舊檔與待匯入狀態保留，下次啟動 (或再呼叫一次) 重試。
+        回傳匯入筆數，沒有待匯入的檔案或匯入失敗時為 None。"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM plan_meta WHERE key = 'legacy_pending'").fetchone()
+        if row is None: return None
+        done = ("DELETE FROM plan_meta WHERE key = 'legacy_pending'", ())
+        if not os.path.exists(row[0]): self._write([done]); return None  # 舊檔已被移走，不再等待
+        try: statements, count = self._import_statements(row[0], replace=True)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.legacy_error = f"{row[0]}: {e}"
+            return None
+        self.legacy_error = None
+        self._write(statements + [done])
+        return count
+
+    def export_json(self, path=None):
+        """匯出成 schedule.json 格式；未指定 path 時回傳 JSON 字串。"""
+        text = json.dumps([{k: p[k] for k in ('日期', '型號', '數量')} for p in self.lines()], ensure_ascii=False)
+        if path is None: return text
+        with open(path, 'w', encoding='utf-8') as f: f.write(text)
+        return path
@@ -0,0 +1,1625 @@
+"""電池模組缺料分析引擎：主檔讀取、排程/交期解析、需求展開、合併共用料與 MRP 推演。
+
+不依賴 Streamlit，可由網頁介面、排程批次或其他 Python 服務直接匯入。
+命令列用法：
+    python -m shortage_engine run --bom 缺料預估.xlsx --stock W08=庫存明細表.xlsx --stock-codes W08=W08 \
+        --stock W26=W26庫存明細表.xlsx --mps 排程.xlsx --suppliers 交期/ --out report.xlsx
+    python -m shortage_engine run --mps 排程.xlsx --tables shortage,groups,movements --out 明細.parquet
+    python -m shortage_engine scenarios --mps 排程.xlsx --suppliers 交期/ --plan schedule.db --spec 情境.json --out diff.xlsx
+"""
+import argparse
+import bisect
+import csv
+import glob
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+
+from plan_store import PlanStore, normalize_plan_lines
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# ==========================================
+# 1. 預設檔案與參數
+# ==========================================
+FILES = {
+    "bom": "缺料預估.xlsx",       
+    "stock_w08": "庫存明細表.xlsx", 
+    "stock_w26": "W26庫存明細表.xlsx"
+}
+# 庫存來源：倉別欄位 → (FILES 鍵, 庫別代碼篩選)；篩選為 None 表示整張表都計入該倉
+STOCK_SOURCES = {
+    "W08": ("stock_w08", ["W08"]),
+    "W26": ("stock_w26", None),
+}
+
+# 主檔讀取快取：清理後的資料存成 xlsx 旁的 .parquet，來源檔變動 (大小/修改時間) 才重新解析
+CACHE_VERSION = 2
+CACHE_META_KEY = b'shortage_hunter_fingerprint'
+
+# 供應商交期檔解析 (openpyxl 為純 Python，執行緒無法平行)：檔案數達 SUPPLIER_POOL_MIN 才分散到多個行程，
+# 每個行程啟動約需 0.5~1 秒，單檔解析約數十毫秒
+SUPPLIER_WORKERS = 8
+SUPPLIER_POOL_MIN = 24
+
+# 共用主檔快照：每隔幾秒檢查一次來源檔是否變動
+MASTER_POLL_SECONDS = 2.0
+
+# 背景工作：同時執行的工作數；送出後先等一小段時間，期間輸入又變動 (工作被取消) 就不必開始計算
+JOB_WORKERS = 2
+JOB_DEBOUNCE_SECONDS = 0.3
+
+# 情境模擬：情境數達此數量才分散到多個行程 (每個行程啟動約需 1 秒)
+SCENARIO_POOL_MIN = 4
+
+# ==========================================
+# 2. 執行階段量測與背景工作
+# ==========================================
+class JobCancelled(Exception):
+    """背景工作已被取消 (送出它的輸入已經變更)。"""
+
+def start_memory_trace():
+    # tracemalloc 是整個行程共用的：開啟後就一直記錄，不在個別階段中停止 (其他執行緒的階段可能正在量測)
+    if not tracemalloc.is_tracing(): tracemalloc.start()
+
+def stop_memory_trace():
+    if tracemalloc.is_tracing(): tracemalloc.stop()
+
+class StageRecorder:
+    """記錄各階段的耗時、進出列數；trace_memory=True 時另記 tracemalloc 記憶體 (會拖慢數倍，預設關閉)。
+    memory_scope='stage' 時每個階段重設峰值，記錄該階段的 peak_kb，只適用於同時只有一個階段在執行 (命令列、效能測試)；
+    'process' (預設) 不重設峰值，只記錄階段結束時整個行程的 process_kb / process_peak_kb，多執行緒同時量測也不互相干擾。
+    current 為進行中的階段 (供其他執行緒顯示進度)；cancel (threading.Event) 被設定後，下一個階段開始時丟出 JobCancelled。
+
+    with recorder.stage("netting", rows_in=n) as rec: ...; rec['rows_out'] = m
+    """
+    def __init__(self, trace_memory=False, run_id=None, cancel=None, memory_scope='process'):
+        self.trace_memory = trace_memory
+        self.memory_scope = memory_scope
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        self.current = None
+        self.cancel = cancel
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **extra):
+        if self.cancel is not None and self.cancel.is_set(): raise JobCancelled(name)
+        rec = {'run': self.run_id, 'stage': name, 'ts': round(time.time(), 3), 'rows_in': rows_in, 'rows_out': None, **extra}
+        self.current = name
+        per_stage = self.trace_memory and self.memory_scope == 'stage'
+        if self.trace_memory: start_memory_trace()
+        if per_stage:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        try: yield rec
+        finally:
+            rec['seconds'] = round(time.perf_counter() - t0, 6)
+            if self.trace_memory and tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                if per_stage: rec['peak_kb'] = round((peak - base) / 1024, 1)
+                else: rec['process_kb'], rec['process_peak_kb'] = round(current / 1024, 1), round(peak / 1024, 1)
+            self.records.append(rec)
+            self.current = None
+
+    def to_jsonl(self): return records_to_jsonl(self.records)
+
+def records_to_jsonl(records): return "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records)
+
+def _stage(recorder, name, rows_in=None, **extra):
+    # 未傳入 recorder 時不做任何量測
+    return recorder.stage(name, rows_in, **extra) if recorder is not None else nullcontext({})
+
+class Job:
+    """一個背景工作：recorder 即時反映已完成的階段與目前階段；owners 為等待結果的使用者 (session)。"""
+    def __init__(self, key, recorder):
+        self.key, self.recorder, self.future, self.owners = key, recorder, None, set()
+
+    def done(self): return self.future.done()
+    def result(self): return self.future.result()
+    def progress(self): return list(self.recorder.records), self.recorder.current
+
+    def cancel(self):
+        self.recorder.cancel.set()
+        self.future.cancel()
+
+    @property
+    def failed(self): return self.future.done() and (self.future.cancelled() or self.future.exception() is not None)
+
+class JobRunner:
+    """整個行程共用的背景工作佇列。fn(recorder) 在工作執行緒中執行，相同 key 的工作只算一次 (多個 session 共用)；
+    同一 owner 送出不同 key 的新工作時，舊工作若已沒有其他人等待就取消 (在下一個階段開始前中止)。"""
+    def __init__(self, max_workers=JOB_WORKERS, debounce=JOB_DEBOUNCE_SECONDS, keep_done=8):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shortage-job")
+        self._debounce, self._keep_done = debounce, keep_done
+        self._jobs, self._owners = {}, {}
+        self._lock = threading.Lock()
+
+    def _run(self, fn, recorder):
+        if recorder.cancel.wait(self._debounce): raise JobCancelled("debounce")
+        return fn(recorder)
+
+    def submit(self, key, fn, owner=None, trace_memory=False):
+        with self._lock:
+            prev = self._owners.get(owner)
+            if prev is not None and prev != key: self._release(owner, prev)
+            job = self._jobs.get(key)
+            if job is None or job.failed:
+                job = self._jobs[key] = Job(key, StageRecorder(trace_memory, cancel=threading.Event()))
+                job.future = self._pool.submit(self._run, fn, job.recorder)
+            job.owners.add(owner)
+            self._owners[owner] = key
+            # 等待者已離開 (如關閉分頁) 而沒被取走的結果，只保留最近幾個
+            finished = [k for k, j in self._jobs.items() if j.done() and k != key]
+            for k in finished[:max(0, len(finished) - self._keep_done)]: del self._jobs[k]
+        return job
+
+    def _release(self, owner, key):
+        job = self._jobs.get(key)
+        if job is None: return
+        job.owners.discard(owner)
+        if not job.owners:
+            if not job.done(): job.cancel()
+            del self._jobs[key]
+
+    def forget(self, key):
+        """結果已由呼叫端保存後移除完成的工作 (釋放結果的參照)。"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.done(): del self._jobs[key]
+
+# ==========================================
+# 3. 料號正規化
+# ==========================================
+def get_base_part_no(raw_no):
+    s = str(raw_no).strip()
+    if len(s) > 0 and s[0] in '0123456789': s = "TW" + s
+    if '-' in s: return s.split('-')[0]
+    return s
+
+def normalize_key(part_no):
+    if pd.isna(part_no): return ""
+    s = str(part_no).upper().strip()
+    s = s.replace("TW", "").replace("-", "").replace(" ", "")
+    return s
+
+def normalize_key_series(parts):
+    # normalize_key 的向量化版本 (整欄一次處理)
+    s = parts.astype(str).str.upper().str.strip()
+    return s.str.replace("TW", "", regex=False).str.replace("-", "", regex=False).str.replace(" ", "", regex=False)
+
+def get_base_part_series(parts):
+    # get_base_part_no 的向量化版本
+    s = parts.astype(str).str.strip()
+    s = s.where(~s.str.match(r'[0-9]'), "TW" + s)
+    return s.str.split('-', n=1).str[0]
+
+class PartKeys:
+    """料號字典：每個料號字串只正規化一次並配給整數 id，之後的比對、分組都用 id。
+    text[id] 為原字串，norm[id] 為 normalize_key 結果的 id，base[id] 為 get_base_part_no 結果 (對應庫存用)。
+    需求帳的摘要 (note) 字串另有一份代碼表 notes。"""
+    def __init__(self):
+        self.index, self.text, self.norm, self.base = {}, [], [], []
+        self.note_index, self.notes = {}, []
+        self._lock = threading.RLock()  # 推演結果跨 session 共用，增量推演時可能同時加入新字串
+
+    def __len__(self): return len(self.text)
+
+    # 情境模擬時整份字典會傳給子行程；鎖不能 pickle，到子行程再重建
+    def __getstate__(self): return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def intern(self, part):
+        i = self.index.get(part)
+        if i is not None: return i
+        with self._lock:
+            i = self.index.get(part)
+            if i is None:
+                norm = normalize_key(part)
+                norm_id = self.intern(norm) if norm != part else None
+                i = len(self.text)
+                self.text.append(part); self.norm.append(i if norm_id is None else norm_id); self.base.append(get_base_part_no(part))
+                self.index[part] = i
+        return i
+
+    def intern_many(self, parts):
+        """字串序列 → id 陣列 (相同字串只查一次字典)。"""
+        codes, uniques = pd.factorize(pd.Series(parts, dtype=object))
+        return np.array([self.intern(u) for u in uniques], dtype=np.int32)[codes]
+
+    def note_code(self, note):
+        i = self.note_index.get(note)
+        if i is not None: return i
+        with self._lock:
+            i = self.note_index.setdefault(note, len(self.notes))
+            if i == len(self.notes): self.notes.append(note)
+        return i
+
+    def note_codes(self, notes):
+        codes, uniques = pd.factorize(pd.Series(notes, dtype=object))
+        return np.array([self.note_code(u) for u in uniques], dtype=np.int32)[codes]
+
+class PartIdentity:
+    """主檔快照的料號身分索引，沿用兩種對應規則：
+    - 需求帳、合併共用料與供應商到貨依正規化料號 (normalize_key) 對應：BOM 中每種料號寫法先在 keys 中配好 id，
+      canonical id (keys.norm) 即正規化料號的 id，bom_parts 為 BOM 料號的 canonical id；
+    - 庫存依基礎料號 (get_base_part_no) 對應：stock 為基礎料號字串 → 各倉數量，庫存料號本身不會放進 keys (沒有 id)，
+      BOM 料件以 keys.base[id] 的字串查 stock。
+    快照建立後 keys 只會再加入新字串 (如需求帳的摘要)，可跨 session 共用。"""
+    def __init__(self, df_bom_sorted=None, bom_cols=None, stock_table=None):
+        self.keys = PartKeys()
+        stock_table = pd.DataFrame() if stock_table is None else stock_table
+        self.warehouses = list(stock_table.columns)
+        self.stock = stock_table.to_dict('index')
+        self.no_stock = dict.fromkeys(self.warehouses, 0)
+        self.bom_parts, self.base_parts, self.models = set(), {}, set()
+        if not bom_cols or df_bom_sorted is None or df_bom_sorted.empty: return
+        c_model, c_part = bom_cols[0], bom_cols[1]
+        ids = self.keys.intern_many(df_bom_sorted[c_part].astype(str).str.strip())
+        for i in pd.unique(ids).tolist():
+            self.bom_parts.add(self.keys.norm[i])
+            self.base_parts.setdefault(self.keys.base[i], []).append(self.keys.text[i])
+        self.models = set(df_bom_sorted[c_model].dropna().tolist())
+
+    def canonical_ids(self, match_keys):
+        """正規化料號字串 → BOM 料號的 canonical id 陣列；不是 BOM 料號的為 -1 (不會加入新字串)。"""
+        codes, uniques = pd.factorize(pd.Series(match_keys, dtype=object))
+        found = [self.keys.index.get(u, -1) for u in uniques]
+        return np.array([i if i in self.bom_parts else -1 for i in found], dtype=np.int32)[codes] if len(codes) else np.zeros(0, dtype=np.int32)
+
+    def unresolved_supplies(self, supplies):
+        """對不到任何 BOM 料號的到貨 (不計入推演)：每個品號一列，附同基礎料號的 BOM 品號作為提示。"""
+        cols = ['品號', '正規化料號', '筆數', '到貨總量', '最早到貨日', '同基礎料號的 BOM 品號']
+        missed = [s for s, i in zip(supplies, self.canonical_ids([s['match_key'] for s in supplies]).tolist()) if i < 0]
+        if not missed: return pd.DataFrame(columns=cols)
+        df = pd.DataFrame({'品號': [s['part_no'] for s in missed], '正規化料號': [s['match_key'] for s in missed],
+                           'qty': [s['qty'] for s in missed], 'date': [s['date'] for s in missed]})
+        report = df.groupby(['品號', '正規化料號'], sort=False).agg(筆數=('qty', 'size'), 到貨總量=('qty', 'sum'), 最早到貨日=('date', 'min')).reset_index()
+        report['同基礎料號的 BOM 品號'] = [" / ".join(self.base_parts.get(get_base_part_no(p), [])[:3]) for p in report['品號'].tolist()]
+        return report[cols]
+
+    def unresolved_models(self, plans):
+        """排程中 BOM 沒有的型號 (不會展開任何需求)。"""
+        cols = ['型號', '來源', '筆數', '數量合計']
+        missed = [p for p in plans if p['型號'] not in self.models]
+        if not missed: return pd.DataFrame(columns=cols)
+        df = pd.DataFrame({'型號': [p['型號'] for p in missed], '來源': [p.get('source', '手動') for p in missed], 'qty': [p['數量'] for p in missed]})
+        return df.groupby(['型號', '來源'], sort=False).agg(筆數=('qty', 'size'), 數量合計=('qty', 'sum')).reset_index()[cols]
+
+# ==========================================
+# 4. 主檔讀取與 Parquet 快取
+# ==========================================
+def file_fingerprint(file_path):
+    info = os.stat(file_path)
+    return {'path': os.path.abspath(file_path), 'size': info.st_size, 'mtime_ns': info.st_mtime_ns, 'version': CACHE_VERSION}
+
+def master_fingerprint(files):
+    return tuple((fp['path'], fp['size'], fp['mtime_ns']) for fp in (file_fingerprint(f) for f in files.values() if os.path.exists(f)))
+
+def _header_names(values):
+    # 與 pd.read_excel(header=N) 相同的欄名規則：空白欄為 Unnamed: i，重複欄名加 .1 / .2
+    names, seen = [], {}
+    for i, v in enumerate(values):
+        name = f"Unnamed: {i}" if pd.isna(v) else v
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else: seen[name] = 0
+        names.append(name)
+    return names
+
+def _frame_from_header(df_raw, target_row):
+    df = df_raw.iloc[target_row + 1:].reset_index(drop=True)
+    df.columns = _header_names(df_raw.iloc[target_row].tolist())
+    return df.infer_objects()
+
+def read_excel_auto_header(file_path, errors=None):
+    if not os.path.exists(file_path): return pd.DataFrame()
+    try:
+        # 單次解析：整張表只讀一次，再從前 10 列找出表頭
+        df_raw = pd.read_excel(file_path, header=None, engine='openpyxl')
+        target_row = 0
+        for idx in range(min(10, len(df_raw))):
+            row_str = " ".join(df_raw.iloc[idx].astype(str).values)
+            if "品號" in row_str: target_row = idx; break
+        return _frame_from_header(df_raw, target_row)
+    except Exception as e:
+        if errors is not None: errors[file_path] = str(e)
+        return pd.DataFrame()
+
+def clean_df(df):
+    if df.empty: return df
+    df.columns = [str(c).strip() for c in df.columns]
+    part_col = next((c for c in df.columns if '品號' in c), None)
+    if part_col:
+        df = df.dropna(subset=[part_col]) 
+        df = df[~df[part_col].astype(str).str.contains('小計|合計|總計', na=False)].infer_objects()
+    # 文字與數字混雜的欄位統一轉為文字，確保可寫入 Parquet 快取且每次讀取結果一致
+    for c in df.columns[df.dtypes == object]:
+        values = df[c].dropna()
+        if values.map(type).nunique() > 1: df[c] = df[c].map(lambda v: v if pd.isna(v) else str(v))
+    return _normalize_nulls(df)
+
+def _normalize_nulls(df):
+    # 文字欄的空白儲存格一律為 NaN：新讀取時是 NaN，經 Parquet 快取讀回時會變成 None，兩者要一致
+    for c in df.columns[df.dtypes == object]:
+        if df[c].isna().any(): df[c] = df[c].where(df[c].notna(), np.nan)
+    return df
+
+# 型別化讀取：只保留流程用得到的欄位，重複值多的文字欄 (型號、品號、庫別) 存成 category，數量欄無損降位
+def typed_columns(columns, kind):
+    """kind 為 'bom' 或 'stock'；回傳 {欄名: 型別}，型別為 'category'、'number' 或 None (照原樣)。
+    必要欄位找不到時回傳 None (整張表照原樣讀取，之後的欄位偵測照常回報錯誤)。"""
+    if kind == 'bom':
+        try: c_model, c_part, c_code, c_name, c_usage = bom_column_names(columns)
+        except StopIteration: return None
+        spec = {c_code: None, c_name: None, c_usage: 'number', c_model: 'category', c_part: 'category'}
+    else:
+        col_p, col_wh, col_q = stock_column_names(columns)
+        if not col_p or not col_q: return None
+        spec = {col_wh: 'category', col_q: 'number', col_p: 'category'}
+    return {c: t for c, t in spec.items() if c is not None}
+
+def downcast_numbers(s):
+    """數值欄無損降位：整數且在範圍內 → int32；浮點數轉 float32 後數值不變 → float32；其他維持原樣。"""
+    if s.dtype.kind in 'iu':
+        info = np.iinfo(np.int32)
+        if s.empty or (s.min() >= info.min and s.max() <= info.max): return s.astype(np.int32)
+    elif s.dtype.kind == 'f':
+        small = s.astype(np.float32)
+        if np.array_equal(small.to_numpy(np.float64), s.to_numpy(), equal_nan=True): return small
+    return s
+
+def _excel_cell(v):
+    # 與 pd.read_excel (openpyxl) 相同的儲存格轉換：空白為 ""、錯誤值為 NaN、整數值的浮點數轉成 int
+    if v is None: return ""
+    if isinstance(v, str): return np.nan if v in ERROR_CODES else v
+    if isinstance(v, float) and v.is_integer(): return int(v)
+    return v
+
+def read_excel_typed(file_path, kind, errors=None):
+    """型別化讀取 (已清理)：逐列串流讀取，找到表頭後只留下 typed_columns 的欄位，再清除空白/小計列並轉換型別。
+    保留下來的欄位內容與 clean_df(read_excel_auto_header(...)) 的同名欄位相同。"""
+    if not os.path.exists(file_path): return pd.DataFrame()
+    try:
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            ws.reset_dimensions()
+            rows, target_row, keep, spec = [], None, None, None
+            for row in ws.iter_rows(values_only=True):
+                if keep is None:
+                    rows.append([_excel_cell(v) for v in row])
+                    if "品號" in " ".join(str(v) for v in row): target_row = len(rows) - 1
+                    elif len(rows) < 10: continue
+                    if target_row is None: target_row = 0
+                    names = [str(c).strip() for c in _header_names([np.nan if v == "" else v for v in rows[target_row]])]
+                    spec = typed_columns(names, kind)
+                    if spec is None: break
+                    keep = sorted(names.index(c) for c in spec)  # 保持原檔欄位順序
+                    rows = [[r[i] if i < len(r) else "" for i in keep] for r in rows]
+                    continue
+                rows.append([_excel_cell(row[i]) if i < len(row) else "" for i in keep])
+        finally: wb.close()
+    except Exception as e:
+        if errors is not None: errors[file_path] = str(e)
+        return pd.DataFrame()
+    if spec is None: return clean_df(read_excel_auto_header(file_path, errors))
+    df_raw = TextParser(rows, header=None, skip_blank_lines=False).read()
+    df = df_raw.iloc[target_row + 1:].reset_index(drop=True)
+    df.columns = [names[i] for i in keep]
+    df = clean_df(df.infer_objects())
+    for c, dtype in spec.items():
+        if dtype == 'category': df[c] = df[c].astype('category')
+        elif dtype == 'number': df[c] = downcast_numbers(df[c])
+    return df
+
+def _sidecar_path(file_path): return file_path + ".parquet"
+
+def _read_sidecar(file_path, fingerprint):
+    path = _sidecar_path(file_path)
+    if pq is None or not os.path.exists(path): return None
+    try:
+        meta = pq.read_schema(path).metadata or {}
+        if json.loads(meta.get(CACHE_META_KEY, b'null')) != fingerprint: return None
+        return _normalize_nulls(pq.read_table(path).to_pandas())
+    except Exception: return None
+
+def _write_sidecar(file_path, fingerprint, df):
+    if pq is None: return
+    path = _sidecar_path(file_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        table = pa.Table.from_pandas(df)
+        meta = dict(table.schema.metadata or {})
+        meta[CACHE_META_KEY] = json.dumps(fingerprint).encode('utf-8')
+        pq.write_table(table.replace_schema_metadata(meta), tmp_path)
+        os.replace(tmp_path, path)  # 原子替換，其他行程不會讀到寫一半的檔案
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def load_clean_table(file_path, errors=None, kind=None):
+    """讀取並清理主檔；以 路徑+大小+修改時間 為鍵，命中時直接讀取旁邊的 Parquet 快取。
+    kind ('bom' / 'stock') 不為 None 時使用型別化讀取 (read_excel_typed)，否則保留全部欄位。"""
+    if not os.path.exists(file_path): return pd.DataFrame()
+    fingerprint = {**file_fingerprint(file_path), 'typed': kind}
+    cached = _read_sidecar(file_path, fingerprint)
+    if cached is not None: return cached
+    df = read_excel_typed(file_path, kind, errors) if kind else clean_df(read_excel_auto_header(file_path, errors))
+    if not df.empty: _write_sidecar(file_path, fingerprint, df)
+    return df
+
+def load_master_data(files=FILES, stock_sources=STOCK_SOURCES, recorder=None):
+    """讀取 BOM 與各庫存表 → (df_bom, {FILES 鍵: 庫存表}, 讀取錯誤, 訊息)。"""
+    read_errors, logs = {}, []
+    with _stage(recorder, "load_data:bom") as rec:
+        df_bom = load_clean_table(files["bom"], read_errors, kind='bom')
+        rec['rows_out'] = len(df_bom)
+    stock_frames = {}
+    for file_key, _ in stock_sources.values():
+        if file_key in stock_frames: continue
+        with _stage(recorder, f"load_data:{file_key}") as rec:
+            stock_frames[file_key] = load_clean_table(files[file_key], read_errors, kind='stock')
+            rec['rows_out'] = len(stock_frames[file_key])
+        if stock_frames[file_key].empty and files[file_key] not in read_errors:
+            logs.append(f"⚠️ {files[file_key]} 內容為空或讀取失敗")
+    return df_bom, stock_frames, read_errors, logs
+
+def bom_column_names(columns):
+    """回傳 (型號, 品號, 項目代號, 品名, 用量) 欄名；型號或品號欄缺少時拋出 StopIteration。"""
+    c_model = next(c for c in columns if '型號' in c)
+    c_part = next(c for c in columns if '品號' in c)
+    c_code = next((c for c in columns if '項目' in c or '代號' in c), None)
+    c_name = next((c for c in columns if '品名' in c), None)
+    c_usage = next((c for c in columns if '用量' in c), None)
+    return c_model, c_part, c_code, c_name, c_usage
+
+def detect_bom_columns(df_bom): return bom_column_names(df_bom.columns)
+
+def stock_column_names(columns):
+    """回傳庫存表的 (品號, 庫別, 庫存數量) 欄名，找不到的為 None；數量欄優先取名稱含「庫存」者。"""
+    candidates = [c for c in columns if '數量' in c]
+    stock_cols = [c for c in candidates if '庫存' in c]
+    col_q = stock_cols[0] if stock_cols else (candidates[0] if candidates else None)
+    col_p = next((c for c in columns if '品號' in c), None)
+    col_wh = next((c for c in columns if '庫別' in c), None)
+    return col_p, col_wh, col_q
+
+def sort_bom(df_bom, bom_cols):
+    c_model, c_part, c_code, _, _ = bom_cols
+    if c_code:
+        df_bom[c_code] = df_bom[c_code].fillna('').astype(str)
+        df_bom['_sort_num'] = df_bom[c_code].str.extract(r'(\d+)').astype(float).fillna(0)
+        return df_bom.sort_values(by=[c_model, '_sort_num', c_part])
+    return df_bom.sort_values(by=[c_model, c_part])
+
+# ==========================================
+# 5. 排程 (MPS) 與供應商交期解析
+# ==========================================
+def read_first_sheet(data):
+    # openpyxl 唯讀串流模式，直接取出儲存格值 (等同 pd.read_excel(header=None) 的第一張工作表)
+    # 不相信檔案記錄的 <dimension> (有些系統匯出的範圍比實際資料小，照它讀會少列/少欄)，與 pandas 相同先重設
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = list(ws.iter_rows(values_only=True))
+    finally: wb.close()
+    return pd.DataFrame(rows)
+
+def parse_mps_workbook(data):
+    """解析排程檔成長表 (day, 日期, 型號, 數量)，尚未套用 ignore_days；回傳 (長表, 錯誤訊息)。"""
+    try:
+        df = _frame_from_header(read_first_sheet(data), 0)
+        date_col = next((c for c in df.columns if 'Date' in str(c) or '日期' in str(c)), None)
+        if not date_col: return None, "❌ 找不到 [Date] 欄位"
+        
+        target_cols, models = [], []
+        for c in df.columns:
+            clean_c = str(c).replace('\n', '').replace(' ', '')
+            if '計畫' in clean_c and '產出' in clean_c:
+                model_name = clean_c.replace('計畫', '').replace('產出', '').strip()
+                if model_name: target_cols.append(c); models.append(model_name)
+        if not target_cols: return None, "⚠️ 找不到任何 [計畫產出] 欄位"
+
+        days = pd.to_datetime(pd.Series(df[date_col].to_numpy(), dtype=object), errors='coerce', format='mixed').dt.normalize()
+        qty = np.column_stack([pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=float) for c in target_cols])
+        # 逐列、逐型號展開成長表 (row-major，與原本逐列讀取的順序相同)
+        rows, cols = np.nonzero((qty > 0) & np.isfinite(qty) & days.notna().to_numpy()[:, None])
+        long_df = pd.DataFrame({
+            'day': days.to_numpy()[rows],
+            '型號': np.array(models, dtype=object)[cols],
+            '數量': np.trunc(qty[rows, cols]).astype(np.int64),
+        })
+        long_df['日期'] = long_df['day'].dt.strftime('%Y-%m-%d')
+        return long_df, None
+    except Exception as e:
+        return None, f"❌ MPS 讀取失敗: {str(e)}"
+
+def mps_plan_lines(long_df, ignore_days=1, today=None):
+    """套用 ignore_days：今天 + N 天之前的排程不計 → (排程列, 截止日)。"""
+    cutoff_date = (today or date.today()) + timedelta(days=ignore_days)
+    kept = long_df[long_df['day'] >= pd.Timestamp(cutoff_date)]
+    mps_list = [{'日期': d, '型號': m, '數量': q, 'source': 'MPS'} for d, m, q in zip(kept['日期'].tolist(), kept['型號'].tolist(), kept['數量'].tolist())]
+    return mps_list, cutoff_date
+
+def parse_supplier_workbook(data):
+    """解析單一供應商交期表 → (到貨記錄, 狀態圖示, 訊息)。"""
+    try:
+        df_raw = read_first_sheet(data)
+        head = df_raw.iloc[:15].astype(str)
+        hits = np.argwhere(head.apply(lambda col: col.str.contains("品號", regex=False)).to_numpy())
+        if not len(hits): return [], "❌", "未偵測到品號欄"
+        header_row_idx, part_col_idx = (int(v) for v in hits[0])
+
+        # 表頭前一列到後五列之間，第一個含有日期的列即為日期列
+        date_col_map = {}
+        for r in range(max(0, header_row_idx - 1), min(len(df_raw), header_row_idx + 6)):
+            parsed = pd.to_datetime(pd.Series(df_raw.iloc[r].to_numpy(), dtype=object), errors='coerce', format='mixed')
+            if parsed.notna().any():
+                date_col_map = dict(zip(np.flatnonzero(parsed.notna()).tolist(), parsed.dropna().dt.strftime('%Y-%m-%d').tolist()))
+                break
+        if not date_col_map: return [], "⚠️", "未偵測到日期欄"
+
+        body = df_raw.iloc[header_row_idx + 1:]
+        raw_parts = body.iloc[:, part_col_idx]
+        parts = raw_parts.astype(str).str.strip()
+        valid = raw_parts.notna().to_numpy() & (parts != '').to_numpy() & (parts.str.lower() != 'nan').to_numpy()
+        date_cols = list(date_col_map)
+        qty = body.iloc[:, date_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        rows, cols = np.nonzero((qty > 0) & valid[:, None])  # 逐列展開 (row-major)
+        part_list = parts.to_numpy()[rows].tolist()
+        keys = normalize_key_series(pd.Series(part_list, dtype=object)).tolist() if part_list else []
+        dates = [date_col_map[date_cols[c]] for c in cols.tolist()]
+        supplies = [{'date': d, 'type': 'supply', 'note': "🚛 到貨", 'part_no': p, 'match_key': k, 'qty': q}
+                    for d, p, k, q in zip(dates, part_list, keys, qty[rows, cols].tolist())]
+        return supplies, "✅", f"{len(supplies)} 筆"
+    except Exception as e: return [], "❌", str(e)
+
+def parse_supplier_files(blobs, workers=None):
+    """批次解析多個供應商交期檔 (bytes)；回傳順序與輸入相同。
+    檔案數 ≥ SUPPLIER_POOL_MIN 時分散到 workers 個行程 (預設 CPU 數，最多 SUPPLIER_WORKERS)，否則逐檔解析。"""
+    if not blobs: return []
+    workers = min(workers or os.cpu_count() or 1, SUPPLIER_WORKERS, len(blobs))
+    if workers <= 1 or len(blobs) < SUPPLIER_POOL_MIN: return [parse_supplier_workbook(b) for b in blobs]
+    # 與情境模擬相同，用 spawn 避免在多執行緒的伺服器中 fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(parse_supplier_workbook, blobs, chunksize=max(1, len(blobs) // (workers * 4))))
+
+# ==========================================
+# 6. 庫存彙總
+# ==========================================
+def process_stock(df, codes=None):
+    """單一庫存表依基礎料號加總；codes 不為 None 時只計入指定庫別。回傳 (Series, 訊息)。"""
+    if df.empty: return pd.Series(dtype=float), None
+    col_p, col_wh, col_q = stock_column_names(df.columns)
+    if not col_q or not col_p: return pd.Series(dtype=float), "找不到 [品號] 或 [庫存數量] 欄位"
+    if codes is not None and col_wh: df = df[df[col_wh].astype(str).str.strip().isin(codes)]
+    qty = pd.to_numeric(df[col_q], errors='coerce').fillna(0)
+    qty = qty.astype(np.int64 if qty.dtype.kind in 'iu' else np.float64)  # 型別化讀取的 int32/float32 先升位再加總，避免溢位
+    return qty.groupby(get_base_part_series(df[col_p]), sort=False).sum(), None
+
+def aggregate_stock(stock_frames, sources=STOCK_SOURCES):
+    """各倉庫存合併成一張表：索引為基礎料號，每個倉別一欄。"""
+    columns, logs = {}, []
+    for wh, (file_key, codes) in sources.items():
+        columns[wh], err = process_stock(stock_frames.get(file_key, pd.DataFrame()), codes)
+        if err: logs.append(f"⚠️ {wh}: {err}")
+    table = pd.DataFrame(columns).fillna(0)
+    table.index.name = 'base'
+    return table, logs
+
+def build_master_snapshot(files=FILES, stock_sources=STOCK_SOURCES, recorder=None):
+    """讀取並整理全部主檔：BOM (原始/排序後)、BOM 欄位、型號清單、各庫存表、彙總庫存與料號身分索引。
+    快照建立後視為唯讀，可由多個 session 同時使用。BOM 欄位偵測失敗時 bom_cols、search_index 為 None。"""
+    # 先取指紋再讀檔：讀取期間檔案若又被改，下一次檢查就會重建
+    fingerprint = master_fingerprint(files)
+    df_bom, stock_frames, read_errors, logs = load_master_data(files, stock_sources, recorder)
+    try: bom_cols = detect_bom_columns(df_bom)
+    except StopIteration: bom_cols = None
+    df_bom_sorted = sort_bom(df_bom, bom_cols) if bom_cols else df_bom
+    with _stage(recorder, "process_stock", rows_in=sum(len(df) for df in stock_frames.values())) as rec:
+        stock_table, stock_logs = aggregate_stock(stock_frames, stock_sources)
+        rec['rows_out'] = len(stock_table)
+    with _stage(recorder, "part_identity", rows_in=len(df_bom_sorted) + len(stock_table)) as rec:
+        identity = PartIdentity(df_bom_sorted, bom_cols, stock_table)
+        rec['rows_out'] = len(identity.keys)
+    with _stage(recorder, "search_index", rows_in=len(df_bom_sorted)) as rec:
+        search_index = SearchIndex(df_bom_sorted, bom_cols) if bom_cols else None
+    return {
+        'fingerprint': fingerprint,
+        'df_bom': df_bom,
+        'df_bom_sorted': df_bom_sorted,
+        'bom_cols': bom_cols,
+        'unique_models': df_bom_sorted[bom_cols[0]].dropna().unique().tolist() if bom_cols else [],
+        'stock_frames': stock_frames,
+        'stock_table': stock_table,
+        'identity': identity,
+        'search_index': search_index,
+        'read_errors': read_errors,
+        'logs': logs + stock_logs,
+    }
+
+class MasterData:
+    """整個行程共用的主檔快照。get() 最多每 poll_interval 秒比對一次來源檔 (大小/修改時間)，
+    有變動才重建；新快照建好後整個換上，已取得舊快照的 session 仍使用一致的舊資料。"""
+    def __init__(self, files=FILES, stock_sources=STOCK_SOURCES, poll_interval=MASTER_POLL_SECONDS):
+        self.files, self.stock_sources, self.poll_interval = files, stock_sources, poll_interval
+        self._snapshot = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def is_current(self):
+        """目前的快照可直接使用 (get() 不需重建) 時為 True。"""
+        snap = self._snapshot
+        if snap is None: return False
+        return time.monotonic() - self._checked < self.poll_interval or master_fingerprint(self.files) == snap['fingerprint']
+
+    def get(self, recorder=None):
+        snap = self._snapshot
+        if snap is not None and time.monotonic() - self._checked < self.poll_interval: return snap
+        with self._lock:  # 同時只有一個執行緒重建，其他執行緒等它完成後直接取用新快照
+            snap = self._snapshot
+            if snap is None or master_fingerprint(self.files) != snap['fingerprint']:
+                snap = self._snapshot = build_master_snapshot(self.files, self.stock_sources, recorder)
+            self._checked = time.monotonic()
+        return snap
+
+# ==========================================
+# 7. 需求展開、合併共用料與 MRP 推演
+# ==========================================
+EVENT_SUPPLY, EVENT_DEMAND = 0, 1
+EVENT_TYPES = ('supply', 'demand')
+
+def to_days(dates):
+    """'YYYY-MM-DD' 字串 → 日序數 (1970-01-01 起算)，大小順序與字串排序相同。"""
+    codes, uniques = pd.factorize(pd.Series(dates, dtype=object))
+    days = pd.to_datetime(pd.Series(uniques, dtype=object), format='%Y-%m-%d').to_numpy().astype('datetime64[D]').astype(np.int32)
+    return days[codes]
+
+def day_strings(days): return np.datetime_as_string(np.asarray(days).astype('datetime64[D]'), unit='D')
+
+class Ledger:
+    """需求/到貨帳：每筆異動一列，以型別化陣列存放 (料號 id、日序數、帶正負號數量、摘要代碼、種類)。
+    需求為負數、到貨為正數；同一料號的異動依加入順序排列 (需求在前，到貨依上傳順序在後)。"""
+    __slots__ = ('key', 'day', 'qty', 'note', 'kind')
+
+    def __init__(self, key=(), day=(), qty=(), note=(), kind=()):
+        self.key = np.asarray(key, dtype=np.int32)
+        self.day = np.asarray(day, dtype=np.int32)
+        self.qty = np.asarray(qty, dtype=float)
+        self.note = np.asarray(note, dtype=np.int32)
+        self.kind = np.full(len(self.key), kind, dtype=np.int8) if np.ndim(kind) == 0 else np.asarray(kind, dtype=np.int8)
+
+    def __len__(self): return len(self.key)
+
+    def take(self, idx): return Ledger(self.key[idx], self.day[idx], self.qty[idx], self.note[idx], self.kind[idx])
+
+    def concat(self, other):
+        return Ledger(*(np.concatenate((getattr(self, f), getattr(other, f))) for f in self.__slots__))
+
+    @property
+    def nbytes(self): return sum(getattr(self, f).nbytes for f in self.__slots__)
+
+def build_model_requirements(df_bom, c_model, c_part, c_usage, keys):
+    """每個型號的料件需求表 (model, key, usage, key_id)：同型號同料號取最大用量，只保留用量 > 0 的料件。"""
+    if c_usage is None or df_bom.empty: return pd.DataFrame({'model': [], 'key': [], 'usage': [], 'key_id': np.zeros(0, dtype=np.int32)})
+    reqs = pd.DataFrame({
+        'model': df_bom[c_model].astype(object),
+        'key': normalize_key_series(df_bom[c_part].astype(str).str.strip()),
+        'usage': pd.to_numeric(df_bom[c_usage], errors='coerce'),
+    })
+    reqs = reqs[reqs['usage'] > 0]
+    # sort=False：保留料號在排序後 BOM 中首次出現的順序
+    reqs = reqs.groupby(['model', 'key'], sort=False)['usage'].max().reset_index()
+    reqs['key_id'] = keys.intern_many(reqs['key'])
+    return reqs
+
+def build_demand_ledger(all_plans, model_reqs, keys):
+    """將排程 (手動 + MPS) 與型號需求表一次合併，展開成各料號的需求帳 (Ledger)。"""
+    if not all_plans or model_reqs.empty: return Ledger()
+    sorted_plan_data = sorted(all_plans, key=lambda x: x['日期'])
+    plans = pd.DataFrame({
+        'day': to_days([p['日期'] for p in sorted_plan_data]),
+        'model': pd.Series([p['型號'] for p in sorted_plan_data], dtype=object),
+        'plan_qty': [p['數量'] for p in sorted_plan_data],
+        'note': keys.note_codes([f"生產({'MPS' if p.get('source') == 'MPS' else '手動'}): {p['型號']}" for p in sorted_plan_data]),
+    })
+    plans['plan_seq'] = range(len(plans))
+    reqs = model_reqs.assign(req_seq=range(len(model_reqs)))
+    exploded = plans.merge(reqs, on='model', how='inner').sort_values(['plan_seq', 'req_seq'], kind='stable')
+    qty = (exploded['plan_qty'] * exploded['usage']).to_numpy(dtype=float)
+    return Ledger(exploded['key_id'].to_numpy(), exploded['day'].to_numpy(), -qty, exploded['note'].to_numpy(), EVENT_DEMAND)
+
+def attach_supplies(demand_ledger, supplies, identity):
+    """供應商到貨併入需求帳：以正規化料號對應 BOM 料號 (本次沒有需求的料號也會入帳)；
+    對不到 BOM 料號的到貨不入帳，由 identity.unresolved_supplies 列出。"""
+    if not supplies: return demand_ledger
+    ids = identity.canonical_ids([s['match_key'] for s in supplies])
+    found = np.flatnonzero(ids >= 0)
+    rows = [supplies[i] for i in found.tolist()]
+    supply_ledger = Ledger(ids[found], to_days([s['date'] for s in rows]), [s['qty'] for s in rows], identity.keys.note_codes([s['note'] for s in rows]), EVENT_SUPPLY)
+    return demand_ledger.concat(supply_ledger)
+
+def bom_group_keys(df_bom, bom_cols):
+    """每列 BOM 的 (品號, 項目代號, 合併鍵)：有群組代碼就用代碼，否則用料號。"""
+    c_model, c_part, c_code, c_name, c_usage = bom_cols
+    p_nos = [str(v).strip() for v in df_bom[c_part].tolist()]
+    codes = [str(v).strip() for v in df_bom[c_code].tolist()] if c_code else [''] * len(p_nos)
+    return p_nos, codes, [c if (c and c.lower()!='nan') else p for p, c in zip(p_nos, codes)]
+
+def consolidate_groups(target_df, bom_cols, identity):
+    """合併共用料：同一項目代號 (無代號則同品號) 的 BOM 列併成一組，庫存依基礎料號去重加總。
+    每個料件的 key_id 為其正規化料號的 canonical id (對應需求帳)。"""
+    c_model, c_part, c_code, c_name, c_usage = bom_cols
+    keys, stock_lookup, no_stock = identity.keys, identity.stock, identity.no_stock
+    consolidated_groups = {}
+
+    n = len(target_df)
+    p_nos, codes, group_keys = bom_group_keys(target_df, bom_cols)
+    part_ids = keys.intern_many(p_nos).tolist()
+    names = target_df[c_name].tolist() if c_name else [''] * n
+    usages = target_df[c_usage].tolist() if c_usage else [0] * n
+
+    for p_no, pid, p_code, key, model, name, usage in zip(p_nos, part_ids, codes, group_keys, target_df[c_model].tolist(), names, usages):
+        bom_base = keys.base[pid]
+        
+        my_stock = stock_lookup.get(bom_base, no_stock)
+        my_net = sum(my_stock.values())
+        item_data = {'p_no': p_no, 'base': bom_base, 'key_id': keys.norm[pid], 'name': name, 'usage': float(usage), 'stock': my_stock, 'net_stock': my_net}
+
+        if key not in consolidated_groups:
+            consolidated_groups[key] = {
+                'models': {model}, # 使用 Set 來自動去重型號
+                'code': p_code, 
+                'items': [item_data], 
+                'req_key': key, 
+                'stock_totals': dict(my_stock), 
+                'total_net': my_net,
+                'seen_parts': {bom_base}
+            }
+        else:
+            group = consolidated_groups[key]
+            group['models'].add(model)
+            if bom_base not in group['seen_parts']:
+                group['items'].append(item_data)
+                for wh, qty in my_stock.items(): group['stock_totals'][wh] += qty
+                group['total_net'] += my_net
+                group['seen_parts'].add(bom_base)
+
+    grouped_data = list(consolidated_groups.values())
+    for g in grouped_data:
+        g['model'] = ", ".join(sorted(list(g['models'])))
+    return grouped_data
+
+def _segmented_cumsum(start_values, counts, values, cell_budget=2_000_000):
+    """各群組從 start_values 起依序累加 values (values 已依群組連續排列)。
+    以 2D 矩陣逐列 np.cumsum，浮點結果與逐筆 Python 累加完全相同；群組依長度分塊以限制補零的記憶體。"""
+    out = np.empty(len(values), dtype=float)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])) if len(counts) else np.zeros(0, dtype=int)
+    order = np.argsort(counts, kind='stable')
+    order = order[counts[order] > 0]
+    i = 0
+    while i < len(order):
+        j = i + 1
+        while j < len(order) and (j + 1 - i) * (counts[order[j]] + 1) <= cell_budget: j += 1
+        block = order[i:j]
+        n = counts[block]
+        rows = np.repeat(np.arange(len(block)), n)
+        cols = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        src = np.repeat(offsets[block], n) + cols
+        mat = np.zeros((len(block), n.max() + 1))
+        mat[:, 0] = start_values[block]
+        mat[rows, cols + 1] = values[src]
+        out[src] = np.cumsum(mat, axis=1)[rows, cols + 1]
+        i = j
+    return out
+
+def _group_movements(groups, ledger):
+    """各群組的異動 (群組索引, 日序數, 摘要代碼, 數量, 種類, 原順序)，需求數量已轉為正數；
+    群組料同一工單 (date, note) 的需求已取最大值。群組沒有任何異動時回傳 None。"""
+    present = set(np.unique(ledger.key).tolist())
+    member_group, member_key = [], []
+    for gi, g in enumerate(groups):
+        seen = set()
+        for item in g['items']:
+            k = item['key_id']
+            if k in present and k not in seen: seen.add(k); member_group.append(gi); member_key.append(k)
+    if not member_key: return None
+
+    # 每個 (群組, 料號) 依序取出該料號的所有異動；列的順序即 (群組, 料號順序, 異動順序)
+    order = np.argsort(ledger.key, kind='stable')
+    sorted_keys = ledger.key[order]
+    first = np.searchsorted(sorted_keys, member_key, 'left')
+    n = np.searchsorted(sorted_keys, member_key, 'right') - first
+    ev = order[np.repeat(first, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)]
+    grp = np.repeat(np.asarray(member_group), n)
+    pos = np.arange(len(ev))
+    day, note, kind, qty = ledger.day[ev], ledger.note[ev], ledger.kind[ev], ledger.qty[ev]
+
+    # ★ 群組料同一工單 (date, note) 取最大值而非累加；供給全部保留
+    is_demand = kind == EVENT_DEMAND
+    demands = pd.DataFrame({'group': grp[is_demand], 'day': day[is_demand], 'note': note[is_demand], 'qty': -qty[is_demand], 'pos': pos[is_demand]})
+    demands = demands.groupby(['group', 'day', 'note'], sort=False).agg(qty=('qty', 'max'), pos=('pos', 'min')).reset_index()
+    is_supply = ~is_demand
+    grp = np.concatenate((grp[is_supply], demands['group'].to_numpy()))
+    day = np.concatenate((day[is_supply], demands['day'].to_numpy()))
+    note = np.concatenate((note[is_supply], demands['note'].to_numpy()))
+    qty = np.concatenate((qty[is_supply], demands['qty'].to_numpy(dtype=float)))
+    kind = np.concatenate((kind[is_supply], np.full(len(demands), EVENT_DEMAND, dtype=np.int8)))
+    pos = np.concatenate((pos[is_supply], demands['pos'].to_numpy()))
+    return grp, day, note, qty, kind, pos
+
+def simulate_groups(groups, ledger, keys):
+    """批次 MRP 推演：所有群組的異動合併成一張表，一次算出 total_demand / final_balance /
+    first_shortage_info / simulation_logs，結果與逐群組逐筆推演相同。"""
+    for g in groups:
+        g['total_demand'] = 0; g['final_balance'] = g['total_net']; g['first_shortage_info'] = "-"; g['simulation_logs'] = []
+    movements = _group_movements(groups, ledger)
+    if movements is None: return groups
+    grp, day, note, qty, kind, pos = movements
+    # 同日先到貨後需求，其餘依原順序
+    moves = np.lexsort((pos, kind, day, grp))
+    grp, day, note, qty, kind = grp[moves], day[moves], note[moves], qty[moves], kind[moves]
+
+    demand_mask = kind == EVENT_DEMAND
+    signed = np.where(demand_mask, -qty, qty)
+    counts = np.bincount(grp, minlength=len(groups))
+    start = np.array([float(g['total_net']) for g in groups])
+    balance = _segmented_cumsum(start, counts, signed)
+    demand_run = _segmented_cumsum(np.zeros(len(groups)), counts, np.where(demand_mask & (qty > 0), qty, 0.0))
+
+    last = np.cumsum(counts) - 1
+    dates = day_strings(day).tolist(); notes = [keys.notes[c] for c in note.tolist()]
+    short_idx = np.flatnonzero(demand_mask & (balance < 0))
+    short_groups, first_pos = np.unique(grp[short_idx], return_index=True)
+    first_short = dict(zip(short_groups.tolist(), short_idx[first_pos].tolist()))
+    for gi in np.flatnonzero(counts).tolist():
+        g = groups[gi]
+        g['total_demand'] = demand_run[last[gi]].item()
+        g['final_balance'] = balance[last[gi]].item()
+        if gi in first_short: idx = first_short[gi]; g['first_shortage_info'] = f"{dates[idx]} ({notes[idx]})"
+    for gi, d, n_, t, q, b in zip(grp.tolist(), dates, notes, kind.tolist(), qty.tolist(), balance.tolist()):
+        groups[gi]['simulation_logs'].append({'date': d, 'note': n_, 'type': EVENT_TYPES[t], 'qty': q, 'balance': b})
+    return groups
+
+BUCKET_FREQS = {'D': '日', 'W': '週', 'M': '月'}
+
+def bucket_starts(days, freq):
+    """日序數 → 所屬期間起始日的日序數 (W 為 ISO 週的週一，M 為當月 1 日)。"""
+    days = np.asarray(days, dtype=np.int32)
+    if freq == 'D': return days
+    if freq == 'W': return days - (days + 3) % 7  # 1970-01-01 為週四
+    if freq == 'M': return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int32)
+    raise ValueError(f"未知的期間: {freq} (可用 {', '.join(BUCKET_FREQS)})")
+
+def _bucket_range(first, last, freq):
+    if freq == 'M':
+        months = np.arange(np.datetime64(int(first), 'D').astype('datetime64[M]'), np.datetime64(int(last), 'D').astype('datetime64[M]') + 1)
+        return months.astype('datetime64[D]').astype(np.int32)
+    return np.arange(first, last + 1, 7 if freq == 'W' else 1, dtype=np.int32)
+
+class BucketMatrix:
+    """分期推演結果：群組 × 期間的稠密矩陣。balance 為各期期末預估結餘，demand / supply 為各期需求與到貨量；
+    first_short[i] 為第 i 個群組第一個「有需求且期末結餘 < 0」的期間索引 (無斷料為 -1)。
+    日期間 (D) 的首個斷料期與逐筆推演的首個斷料日相同；週/月期間內先缺後補回的不算斷料。"""
+    __slots__ = ('freq', 'starts', 'req_keys', 'index', 'balance', 'demand', 'supply', 'first_short')
+
+    def __init__(self, freq, starts, req_keys, balance, demand, supply, first_short):
+        self.freq, self.starts, self.req_keys = freq, starts, req_keys
+        self.index = {k: i for i, k in enumerate(req_keys)}
+        self.balance, self.demand, self.supply, self.first_short = balance, demand, supply, first_short
+
+    def __len__(self): return len(self.req_keys)
+
+    def labels(self):
+        """期間標籤：D 為 2026-10-19，W 為 2026-W43，M 為 2026-10。"""
+        days = self.starts.astype('datetime64[D]')
+        if self.freq == 'W': return [f"{y}-W{w:02d}" for y, w, _ in (d.isocalendar() for d in days.tolist())]
+        return np.datetime_as_string(days, unit='M' if self.freq == 'M' else 'D').tolist()
+
+    def first_shortage_labels(self):
+        labels = self.labels()
+        return [labels[b] if b >= 0 else '-' for b in self.first_short.tolist()]
+
+    def to_frame(self, groups, values='balance'):
+        """指定群組 (依傳入順序) 的矩陣表：群組資訊欄 + 每期一欄 (values 為 balance / demand / supply)。"""
+        rows = np.array([self.index[g['req_key']] for g in groups], dtype=np.intp)
+        first = self.first_shortage_labels()
+        info = pd.DataFrame({
+            '型號': [g['model'] for g in groups],
+            '品號': [" / ".join(item['p_no'] for item in g['items']) for g in groups],
+            '品名': [g['items'][0]['name'] for g in groups],
+            '首個斷料期': [first[i] for i in rows.tolist()],
+        })
+        return pd.concat([info, pd.DataFrame(getattr(self, values)[rows], columns=self.labels())], axis=1)
+
+def bucket_netting(groups, ledger, freq='W'):
+    """分期 MRP：各群組的異動依期間加總成矩陣後逐期累加，不產生逐筆推演記錄 (simulation_logs)。
+    不修改 groups；回傳 BucketMatrix，列順序與 groups 相同。"""
+    start = np.array([float(g['total_net']) for g in groups]).reshape(-1, 1)
+    req_keys = [g['req_key'] for g in groups]
+    movements = _group_movements(groups, ledger)
+    if movements is None:
+        empty = np.zeros((len(groups), 0))
+        return BucketMatrix(freq, np.zeros(0, dtype=np.int32), req_keys, empty, empty, empty, np.full(len(groups), -1))
+    grp, day, _, qty, kind, _ = movements
+    bucket = bucket_starts(day, freq)
+    starts = _bucket_range(bucket.min(), bucket.max(), freq)
+    n_buckets, size = len(starts), len(groups) * len(starts)
+    cell = grp * n_buckets + np.searchsorted(starts, bucket)
+    is_demand = kind == EVENT_DEMAND
+    demand = np.bincount(cell[is_demand], weights=qty[is_demand], minlength=size).reshape(len(groups), n_buckets)
+    supply = np.bincount(cell[~is_demand], weights=qty[~is_demand], minlength=size).reshape(len(groups), n_buckets)
+    has_demand = np.bincount(cell[is_demand], minlength=size).reshape(len(groups), n_buckets) > 0
+    balance = start + np.cumsum(supply - demand, axis=1)
+    short = has_demand & (balance < 0)
+    first_short = np.where(short.any(axis=1), short.argmax(axis=1), -1)
+    return BucketMatrix(freq, starts, req_keys, balance, demand, supply, first_short)
+
+def apply_buckets(groups, matrix):
+    """以分期結果填入群組的 total_demand / final_balance / first_shortage_info (首個斷料期)，simulation_logs 留空。"""
+    first = matrix.first_shortage_labels()
+    totals = matrix.demand.sum(axis=1).tolist()
+    finals = matrix.balance[:, -1].tolist() if matrix.balance.shape[1] else [float(g['total_net']) for g in groups]
+    for i, g in enumerate(groups):
+        g['total_demand'] = totals[i]; g['final_balance'] = finals[i]; g['first_shortage_info'] = first[i]; g['simulation_logs'] = []
+    return groups
+
+def sort_by_shortage_date(item):
+    if item['final_balance'] >= 0:
+        return "9999-99-99" 
+    info = item.get('first_shortage_info', '-')
+    if info == '-': return "9999-99-99"
+    return info.split(' ')[0]
+
+def plan_line_counts(all_plans):
+    return Counter((p['日期'], p['型號'], p['數量'], p.get('source') == 'MPS') for p in all_plans)
+
+def _netting_result(ordered, demand_ledger, model_reqs, key_groups, all_plans, supplies, warehouses, identity):
+    return {
+        'groups': sorted(ordered, key=sort_by_shortage_date),
+        'ordered': ordered,              # 合併共用料時的原始順序 (排序同日時的次序依據)
+        'demand_ledger': demand_ledger,  # 只含需求、尚未併入到貨
+        'model_reqs': model_reqs,
+        'key_groups': key_groups,        # 正規化料號 id → 引用它的群組 req_key
+        'plan_lines': plan_line_counts(all_plans),
+        'supplies': supplies,
+        'warehouses': warehouses,
+        'keys': identity.keys,           # 料號字典 (需求帳、key_groups 與料件 key_id 都以其 id 表示)
+        'identity': identity,
+    }
+
+def run_netting(df_bom_sorted, bom_cols, stock_table, all_plans, supplies, scope_models=None, recorder=None, buckets=None, identity=None):
+    """完整推演：需求帳 → 到貨 → 合併共用料 → 批次 MRP；scope_models 為 None 時涵蓋整份 BOM。
+    buckets 為 'D' / 'W' / 'M' 時改用分期推演 (結果另含 'buckets' 矩陣，群組沒有逐筆記錄)。
+    identity 為主檔快照的料號身分索引 (須由同一份 BOM/庫存建立)；未指定時當場建立。
+    回傳結果中的 groups 已依首個斷料日排序。"""
+    c_model, c_part, c_code, c_name, c_usage = bom_cols
+    if identity is None: identity = PartIdentity(df_bom_sorted, bom_cols, stock_table)
+    keys = identity.keys
+    with _stage(recorder, "ledger_build", rows_in=len(all_plans) + len(supplies)) as rec:
+        model_reqs = build_model_requirements(df_bom_sorted, c_model, c_part, c_usage, keys)
+        demand_ledger = build_demand_ledger(all_plans, model_reqs, keys)
+        ledger = attach_supplies(demand_ledger, supplies, identity)
+        rec['rows_out'] = len(ledger)
+    target_df = df_bom_sorted if scope_models is None else df_bom_sorted[df_bom_sorted[c_model].isin(scope_models)]
+    with _stage(recorder, "consolidation", rows_in=len(target_df)) as rec:
+        groups = consolidate_groups(target_df, bom_cols, identity)
+        rec['rows_out'] = len(groups)
+    matrix = None
+    with _stage(recorder, "netting", rows_in=rec.get('rows_out')) as rec:
+        if buckets is None:
+            groups = simulate_groups(groups, ledger, keys)
+            rec['rows_out'] = sum(len(g['simulation_logs']) for g in groups)
+        else:
+            matrix = bucket_netting(groups, ledger, buckets)
+            groups = apply_buckets(groups, matrix)
+            rec['rows_out'] = matrix.balance.size
+    result = _netting_result(groups, demand_ledger, model_reqs, _key_groups(groups), all_plans, supplies, identity.warehouses, identity)
+    result['scope'] = None if scope_models is None else frozenset(scope_models)
+    if matrix is not None: result['buckets'] = matrix
+    return result
+
+def _key_groups(groups):
+    key_groups = {}
+    for g in groups:
+        for item in g['items']: key_groups.setdefault(item['key_id'], set()).add(g['req_key'])
+    return key_groups
+
+NETTING_FIELDS = ('total_demand', 'final_balance', 'first_shortage_info', 'simulation_logs')
+
+def renet_plan_delta(prev, all_plans, recorder=None, df_bom_sorted=None, bom_cols=None, scope_models=None):
+    """排程增刪 (如手動插單) 後的增量推演：只重建變動型號所用料號的需求帳，
+    只重算引用這些料號的群組，其餘群組直接沿用 prev 的結果。
+    有傳入 df_bom_sorted / bom_cols 且 scope_models 與 prev 的範圍不同時 (如「全部顯示」下插單加入了新型號)，
+    依新範圍重新合併共用料 (不含推演，很快)；料件組成與 prev 相同的群組同樣沿用，新出現或組成改變的群組才重算。"""
+    new_lines = plan_line_counts(all_plans)
+    changed = (new_lines - prev['plan_lines']) + (prev['plan_lines'] - new_lines)
+    model_reqs, keys = prev['model_reqs'], prev['keys']
+    affected_keys = set(model_reqs.loc[model_reqs['model'].isin({line[1] for line in changed}), 'key_id'].tolist())
+
+    with _stage(recorder, "ledger_build", rows_in=len(all_plans), incremental=True) as rec:
+        prev_ledger = prev['demand_ledger']
+        demand_ledger = prev_ledger.take(~np.isin(prev_ledger.key, np.fromiter(affected_keys, dtype=np.int32, count=len(affected_keys))))
+        demand_ledger = demand_ledger.concat(build_demand_ledger(all_plans, model_reqs[model_reqs['key_id'].isin(affected_keys)], keys))
+        ledger = attach_supplies(demand_ledger, prev['supplies'], prev['identity'])
+        rec['rows_out'] = len(ledger)
+
+    if df_bom_sorted is None: scope = prev.get('scope')
+    else: scope = None if scope_models is None else frozenset(scope_models)
+    affected_groups = set()
+    if scope == prev.get('scope'): groups, key_groups = prev['ordered'], prev['key_groups']
+    else:
+        target_df = df_bom_sorted if scope is None else df_bom_sorted[df_bom_sorted[bom_cols[0]].isin(scope)]
+        with _stage(recorder, "consolidation", rows_in=len(target_df), incremental=True) as rec:
+            groups = consolidate_groups(target_df, bom_cols, prev['identity'])
+            rec['rows_out'] = len(groups)
+        key_groups = _key_groups(groups)
+        prev_groups = {g['req_key']: g for g in prev['ordered']}
+        for g in groups:
+            p = prev_groups.get(g['req_key'])
+            if p is not None and [item['p_no'] for item in p['items']] == [item['p_no'] for item in g['items']]:
+                g.update({f: p[f] for f in NETTING_FIELDS if f in p})
+            else: affected_groups.add(g['req_key'])
+    for k in affected_keys: affected_groups.update(key_groups.get(k, ()))
+    with _stage(recorder, "netting", rows_in=len(affected_groups), incremental=True) as rec:
+        renetted = simulate_groups([dict(g) for g in groups if g['req_key'] in affected_groups], ledger, keys)
+        rec['rows_out'] = sum(len(g['simulation_logs']) for g in renetted)
+    by_key = {g['req_key']: g for g in renetted}
+    ordered = [by_key.get(g['req_key'], g) for g in groups]
+    result = _netting_result(ordered, demand_ledger, model_reqs, key_groups, all_plans, prev['supplies'], prev['warehouses'], prev['identity'])
+    result['scope'] = scope
+    return result
+
+# ==========================================
+# 8. 品號 / 品名搜尋索引
+# ==========================================
+class TextIndex:
+    """單一欄位的子字串索引：相同字串只存一次，以三字元 n-gram 倒排表找候選再逐一確認。"""
+    NGRAM = 3
+
+    def __init__(self, texts):
+        codes, uniques = pd.factorize(pd.Series([str(t).lower() for t in texts], dtype=object))
+        self.row_codes = codes
+        self.values = list(uniques)
+        postings = {}
+        for i, v in enumerate(self.values):
+            for gram in {v[j:j + self.NGRAM] for j in range(len(v) - self.NGRAM + 1)}: postings.setdefault(gram, []).append(i)
+        self.postings = {g: np.array(ids, dtype=np.int32) for g, ids in postings.items()}
+        self.order = sorted(range(len(self.values)), key=self.values.__getitem__)
+        self.sorted_values = [self.values[i] for i in self.order]
+
+    def match_term(self, term):
+        """符合單一詞的字串 id；`詞*` 為前綴比對，其餘為子字串比對。"""
+        if term.endswith('*'):
+            prefix = term[:-1]
+            lo = bisect.bisect_left(self.sorted_values, prefix)
+            hi = lo
+            while hi < len(self.sorted_values) and self.sorted_values[hi].startswith(prefix): hi += 1
+            return np.array(self.order[lo:hi], dtype=np.int32)
+        if len(term) < self.NGRAM: return np.array([i for i, v in enumerate(self.values) if term in v], dtype=np.int32)
+        lists = sorted((self.postings.get(term[j:j + self.NGRAM]) for j in range(len(term) - self.NGRAM + 1)), key=lambda a: -1 if a is None else len(a))
+        if lists[0] is None: return np.zeros(0, dtype=np.int32)
+        candidates = lists[0]
+        for ids in lists[1:]:
+            candidates = np.intersect1d(candidates, ids, assume_unique=True)
+            if not len(candidates): break
+        if len(term) == self.NGRAM: return candidates
+        # n-gram 全部命中不代表整個詞連續出現，需再確認
+        return np.array([i for i in candidates.tolist() if term in self.values[i]], dtype=np.int32)
+
+    def match_rows(self, query):
+        """query 以空白分隔多個詞 (AND)，回傳每列是否符合 (bool 陣列)；沒有任何詞時回傳 None。"""
+        terms = query.lower().split()
+        if not terms: return None
+        hit = np.ones(len(self.values), dtype=bool)
+        for term in terms:
+            term_hit = np.zeros(len(self.values), dtype=bool)
+            term_hit[self.match_term(term)] = True
+            hit &= term_hit
+        return hit[self.row_codes]
+
+class SearchIndex:
+    """整份 BOM 的品號、品名搜尋索引 (每個主檔快照建一次)。
+    每一列 BOM 都建索引，所以共用料群組裡的替代料號、其他料件的品名也搜得到。"""
+    def __init__(self, df_bom_sorted, bom_cols):
+        c_model, c_part, c_code, c_name, c_usage = bom_cols
+        p_nos, _, group_keys = bom_group_keys(df_bom_sorted, bom_cols)
+        self.group_codes, self.group_keys = pd.factorize(pd.Series(group_keys, dtype=object))
+        self.model_codes, self.models = pd.factorize(df_bom_sorted[c_model].astype(object))
+        self.fields = {
+            'part': TextIndex(p_nos),
+            'name': TextIndex(df_bom_sorted[c_name].tolist() if c_name else [''] * len(p_nos)),
+        }
+
+    def matching_groups(self, queries, scope_models=None):
+        """queries 為 {'part': ..., 'name': ...}，各欄位之間也是 AND。
+        回傳符合的群組合併鍵 (req_key) 集合；只計入 scope_models 內型號的 BOM 列。全部查詢為空時回傳 None。"""
+        rows = None
+        for field, query in queries.items():
+            hit = self.fields[field].match_rows(query or '')
+            if hit is not None: rows = hit if rows is None else rows & hit
+        if rows is None: return None
+        if scope_models is not None:
+            in_scope = np.zeros(len(self.models) + 1, dtype=bool)
+            in_scope[self.models.get_indexer(list(scope_models))] = True
+            in_scope[-1] = False  # get_indexer 找不到的型號為 -1
+            rows = rows & in_scope[self.model_codes]
+        groups = np.zeros(len(self.group_keys), dtype=bool)
+        groups[self.group_codes[rows]] = True
+        return set(self.group_keys[groups].tolist())
+
+# ==========================================
+# 9. 網頁表格 (HTML)
+# ==========================================
+def fmt(n): return f"{int(n):,}"
+
+def render_simulation_table(group):
+    sim_rows = ""
+    for log in group['simulation_logs']:
+        row_cls = "sim-row-supply" if log['type'] == 'supply' else ("sim-row-short" if log['balance'] < 0 else "")
+        qty_display = f"+{fmt(log['qty'])}" if log['type'] == 'supply' else f"-{fmt(log['qty'])}"
+        sim_rows += f'<tr class="{row_cls}"><td>{log["date"]}</td><td>{log["note"]}</td><td style="text-align:center;">{qty_display}</td><td style="text-align:center;">{fmt(log["balance"])}</td></tr>'
+    return f"""<div class="sim-wrapper" style="margin-top: 10px;"><b style="color:#2c3e50;">📅 MRP模擬：</b><table class="sim-table"><thead><tr><th>日期</th><th>摘要</th><th>變動</th><th>結餘</th></tr></thead><tbody>{sim_rows}</tbody></table></div>"""
+
+def render_grouped_html_table(grouped_data, warehouses=tuple(STOCK_SOURCES), inline_simulation=True):
+    """inline_simulation=False 時不在每列內嵌 MRP 模擬表 (分頁模式改由明細區按需產生)。"""
+    html = '<div class="table-wrapper"><table style="width:100%;">'
+    wh_cols = '<col style="width: 80px">   ' * len(warehouses)
+    wh_heads = "".join(f"<th>{wh}</th>" for wh in warehouses)
+    html += f"""
+    <colgroup>
+        <col style="width: 60px">   <col style="width: 150px">  <col style="width: 80px">   <col style="width: 220px">  <col style="width: 200px">  <col style="width: 60px">   {wh_cols}<col style="width: 80px">   <col style="width: 80px">   </colgroup>
+    <thead><tr><th>狀態</th><th>首個斷料點</th><th>型號 (受影響)</th><th>品號 / 群組內容</th><th>品名</th><th>用量</th>{wh_heads}<th>總需求</th><th>最終結餘</th></tr></thead><tbody>
+    """
+    for group in grouped_data:
+        is_short = group['final_balance'] < 0
+        count = len(group['items'])
+        is_group = count > 1
+        tr_style = 'color: #333;'
+        bg_class = 'background-color: #FFEBEE;' if is_short else 'background-color: white;'
+        if is_short: tr_style = 'color: #c0392b; font-weight: 500;'
+        
+        html += f'<tr style="{tr_style} {bg_class}">'
+        status_html = '<span class="badge badge-err">缺料</span>' if is_short else '<span class="badge badge-ok">充足</span>'
+        html += f'<td class="text-center">{status_html}</td>'
+        
+        first_shortage = group.get('first_shortage_info', '-')
+        shortage_style = "color: #c0392b; font-weight: bold;" if is_short else "color: #aaa;"
+        html += f'<td class="text-center" style="{shortage_style}">{first_shortage}</td>'
+        
+        html += f'<td class="text-center" style="text-align: center !important;">{group["model"]}</td>'
+        
+        show_sim = inline_simulation and bool(group['simulation_logs'])
+        if is_group or show_sim:
+            details_inner = ""
+            if is_group:
+                for item in group['items']:
+                    stock_text = " | ".join(f"{wh}:<b>{fmt(item['stock'][wh])}</b>" for wh in warehouses)
+                    details_inner += f'<div style="border-bottom:1px dashed #ccc; padding:6px 0;"><div><span style="color:#444; font-weight:bold;">{item["p_no"]}</span></div><div style="font-size:14px; color:#555;">{stock_text}</div></div>'
+            sim_table_html = render_simulation_table(group) if show_sim else ""
+            summary_text = f"📦 共用料 ({count})" if is_group else group['items'][0]['p_no']
+            details_box = f'<div style="font-size:14px; margin-top:5px; padding-left:5px; border-left:3px solid #ddd;">{details_inner}{sim_table_html}</div>'
+            html += f'<td><details><summary>{summary_text}</summary>{details_box}</details></td>'
+        else:
+            html += f'<td>{group["items"][0]["p_no"]}</td>'
+
+        html += f'<td style="text-align: left !important;">{group["items"][0]["name"]}</td>'
+        
+        usage = max([i['usage'] for i in group['items']])
+        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{usage}</span></td>'
+        for wh in warehouses:
+            html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["stock_totals"][wh])}</span></td>'
+        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["total_demand"])}</span></td>'
+        html += f'<td class="text-center" style="text-align: center !important;"><span class="num-font">{fmt(group["final_balance"])}</span></td></tr>'
+    html += '</tbody></table></div>'
+    return html
+
+# ==========================================
+# 10. 情境模擬 (what-if)
+# ==========================================
+def shift_mps(long_df, days):
+    """MPS 長表整體平移 days 天 (負數為提前)。"""
+    if not days: return long_df
+    shifted = long_df.assign(day=long_df['day'] + pd.Timedelta(days=days))
+    shifted['日期'] = shifted['day'].dt.strftime('%Y-%m-%d')
+    return shifted
+
+def scenario_plans(scenario, manual_plans, mps_long=None, ignore_days=1, today=None):
+    """情境 → 排程列 (手動插單在前、MPS 在後，與網頁相同)。
+    scenario 可含 add (追加插單)、remove (移除的插單 id)、replace_manual (不計現有插單)、
+    shift_mps_days (MPS 平移天數)、ignore_days (取代預設的忽略天數)；空 dict 即現況。"""
+    removed = set(scenario.get('remove', ()))
+    manual = [] if scenario.get('replace_manual') else [p for p in manual_plans if p.get('id') not in removed]
+    plans = [dict(p, source='手動') for p in manual + list(scenario.get('add', ()))]
+    if mps_long is not None:
+        days = scenario.get('ignore_days')
+        plans.extend(mps_plan_lines(shift_mps(mps_long, scenario.get('shift_mps_days', 0)), ignore_days if days is None else days, today)[0])
+    return plans
+
+_scenario_base = None  # 子行程內的基準推演結果 (啟動時收一次，之後每個情境共用)
+
+def _init_scenario_worker(baseline):
+    global _scenario_base
+    _scenario_base = baseline
+
+def _scenario_outcome(all_plans, baseline=None):
+    result = renet_plan_delta(_scenario_base if baseline is None else baseline, all_plans)
+    return {g['req_key']: (g['final_balance'], g['first_shortage_info'], g['total_demand']) for g in result['ordered']}
+
+def _slim_baseline(baseline):
+    # 子行程只回傳結餘，不需要推演明細；少傳 simulation_logs 可大幅減少 pickle 量
+    slim = {k: baseline[k] for k in ('demand_ledger', 'model_reqs', 'key_groups', 'plan_lines', 'supplies', 'warehouses', 'keys', 'identity')}
+    slim['ordered'] = [{k: v for k, v in g.items() if k != 'simulation_logs'} for g in baseline['ordered']]
+    return slim
+
+def evaluate_scenarios(baseline, plan_lists, workers=None):
+    """以 baseline (整份 BOM 的推演結果) 為基準，對每組排程做增量推演 → [{req_key: (最終結餘, 首個斷料點, 總需求)}]。
+    主檔、庫存、合併共用料與到貨只算一次；情境數 ≥ SCENARIO_POOL_MIN 時分散到 workers 個行程 (預設 CPU 數)。"""
+    workers = min(workers or os.cpu_count() or 1, len(plan_lists))
+    if workers <= 1 or len(plan_lists) < SCENARIO_POOL_MIN:
+        return [_scenario_outcome(plans, baseline) for plans in plan_lists]
+    # spawn 避免在多執行緒的伺服器中 fork；基準資料只在每個行程啟動時傳一次
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_scenario_worker, initargs=(_slim_baseline(baseline),)) as pool:
+        return list(pool.map(_scenario_outcome, plan_lists))
+
+def _first_day(info): return None if info == '-' else info.split(' ')[0]
+
+def shortage_change(base_balance, base_info, balance, info):
+    """單一群組相對基準的變化；沒有變化時回傳 None。"""
+    if base_balance >= 0 > balance: return '新增缺料'
+    if balance >= 0 > base_balance: return '恢復充足'
+    d0, d1 = _first_day(base_info), _first_day(info)
+    if d0 == d1: return None
+    if d0 is None: return '出現斷料點'
+    if d1 is None: return '斷料點消失'
+    return '斷料提前' if d1 < d0 else '斷料延後'
+
+def scenario_diff(baseline, names, outcomes):
+    """各情境與基準的差異 → (摘要表, 明細表)；明細只列缺料狀態或首個斷料日有變動的群組，依基準的斷料日排序。"""
+    n_base = sum(1 for g in baseline['groups'] if g['final_balance'] < 0)
+    summary = [{'情境': '基準', '缺料項目': n_base, '新增缺料': 0, '恢復充足': 0, '斷料提前': 0, '斷料延後': 0}]
+    detail = []
+    for name, outcome in zip(names, outcomes):
+        counts = Counter()
+        for g in baseline['groups']:
+            balance, info, _ = outcome[g['req_key']]
+            change = shortage_change(g['final_balance'], g['first_shortage_info'], balance, info)
+            if change is None: continue
+            counts[change] += 1
+            d0, d1 = _first_day(g['first_shortage_info']), _first_day(info)
+            detail.append({
+                '情境': name, '變化': change, '型號': g['model'],
+                '品號': " / ".join(item['p_no'] for item in g['items']), '品名': g['items'][0]['name'],
+                '基準結餘': g['final_balance'], '情境結餘': balance,
+                '基準首個斷料日': d0 or '-', '情境首個斷料日': d1 or '-',
+                '位移天數': (date.fromisoformat(d1) - date.fromisoformat(d0)).days if d0 and d1 else None,
+            })
+        n_short = sum(1 for balance, _, _ in outcome.values() if balance < 0)
+        summary.append({'情境': name, '缺料項目': n_short, **{k: counts[k] for k in ('新增缺料', '恢復充足', '斷料提前', '斷料延後')}})
+    detail_cols = ['情境', '變化', '型號', '品號', '品名', '基準結餘', '情境結餘', '基準首個斷料日', '情境首個斷料日', '位移天數']
+    return pd.DataFrame(summary), pd.DataFrame(detail, columns=detail_cols)
+
+def scenario_names(scenarios): return [s.get('name') or f"情境{i + 1}" for i, s in enumerate(scenarios)]
+
+def run_scenarios(master, manual_plans, mps_long, supplies, scenarios, ignore_days=1, workers=None, today=None, baseline=None, recorder=None):
+    """批次情境模擬：基準 (現有插單 + MPS) 對整份 BOM 完整推演一次，各情境再以增量推演與之比較。
+    baseline 可傳入已算好的整份 BOM 推演結果 (網頁的結果快取)。回傳 (基準結果, 摘要表, 明細表)。"""
+    if baseline is None:
+        base_plans = scenario_plans({}, manual_plans, mps_long, ignore_days, today)
+        baseline = run_netting(master['df_bom_sorted'], master['bom_cols'], master['stock_table'], base_plans, supplies, recorder=recorder, identity=master['identity'])
+    with _stage(recorder, "scenarios", rows_in=len(scenarios)) as rec:
+        plan_lists = [scenario_plans(s, manual_plans, mps_long, ignore_days, today) for s in scenarios]
+        outcomes = evaluate_scenarios(baseline, plan_lists, workers)
+        summary, detail = scenario_diff(baseline, scenario_names(scenarios), outcomes)
+        rec['rows_out'] = len(detail)
+    return baseline, summary, detail
+
+# ==========================================
+# 11. 報表匯出 (逐列串流寫出)
+# ==========================================
+# 各表逐列由推演結果產生 (tuple)，寫檔時不另建 DataFrame；xlsx 以 write-only 模式寫入
+EXPORT_TABLES = {'shortage': '缺料清單', 'groups': '共用料明細', 'movements': 'MRP明細', 'buckets': '分期結餘',
+                 'unresolved_supplies': '未對應到貨', 'unresolved_models': '未對應型號'}
+EXPORT_FORMATS = ('xlsx', 'csv', 'parquet')
+EXPORT_BATCH_ROWS = 50_000   # Parquet 每批列數 (記憶體中只保留一批)
+XLSX_MAX_ROWS = 1_048_575    # 每頁資料列上限 (不含表頭)，超過時接續到下一頁
+
+def _group_parts(g): return " / ".join(item['p_no'] for item in g['items'])
+
+def shortage_report_rows(groups, warehouses):
+    """缺料清單的每一列 (與網頁表格相同欄位)。"""
+    for g in groups:
+        yield ('缺料' if g['final_balance'] < 0 else '充足', g['first_shortage_info'], g['model'], _group_parts(g), g['items'][0]['name'],
+               max(item['usage'] for item in g['items']), *(float(g['stock_totals'][wh]) for wh in warehouses), float(g['total_demand']), float(g['final_balance']))
+
+def group_item_rows(groups, warehouses):
+    """合併共用料的每個料件一列 (含各倉庫存)。"""
+    for g in groups:
+        for item in g['items']:
+            yield (g['req_key'], g['code'], g['model'], item['p_no'], item['base'], item['name'], item['usage'],
+                   *(float(item['stock'][wh]) for wh in warehouses), float(item['net_stock']))
+
+def movement_rows(groups):
+    """每個群組的逐筆推演記錄 (到貨/需求與結餘)；分期推演的結果沒有逐筆記錄。"""
+    kinds = {'supply': '到貨', 'demand': '需求'}
+    for g in groups:
+        parts = _group_parts(g)
+        for log in g['simulation_logs']:
+            yield (g['req_key'], g['model'], parts, log['date'], log['note'], kinds[log['type']], float(log['qty']), float(log['balance']))
+
+def bucket_rows(groups, matrix):
+    first = matrix.first_shortage_labels()
+    for g in groups:
+        i = matrix.index[g['req_key']]
+        yield (g['model'], _group_parts(g), g['items'][0]['name'], first[i], *matrix.balance[i].tolist())
+
+def export_tables(result, tables=('shortage',), groups=None):
+    """要匯出的表 [(表鍵, 欄名, 欄位型別, 逐列產生器)]；欄位型別為 'text' / 'number' / 'int' (Parquet 的欄位型別依此決定)。
+    groups 預設為結果中全部群組。結果中沒有的表 (如非分期推演的 buckets) 略過。"""
+    groups = result['groups'] if groups is None else groups
+    wh = list(result['warehouses'])
+    out = []
+    for key in tables:
+        if key == 'shortage':
+            columns, rows = ['狀態', '首個斷料點', '型號', '品號', '品名', '用量', *wh, '總需求', '最終結餘'], shortage_report_rows(groups, wh)
+            types = ['text'] * 5 + ['number'] * (len(wh) + 3)
+        elif key == 'groups':
+            columns, rows = ['合併鍵', '項目代號', '型號', '品號', '基礎料號', '品名', '用量', *wh, '庫存小計'], group_item_rows(groups, wh)
+            types = ['text'] * 6 + ['number'] * (len(wh) + 2)
+        elif key == 'movements':
+            columns, rows = ['合併鍵', '型號', '品號', '日期', '摘要', '種類', '數量', '結餘'], movement_rows(groups)
+            types = ['text'] * 6 + ['number'] * 2
+        elif key == 'buckets' and 'buckets' in result:
+            labels = result['buckets'].labels()
+            columns, rows = ['型號', '品號', '品名', '首個斷料期', *labels], bucket_rows(groups, result['buckets'])
+            types = ['text'] * 4 + ['number'] * len(labels)
+        elif key in ('unresolved_supplies', 'unresolved_models') and result.get(key) is not None:
+            df = result[key]
+            columns, rows = list(df.columns), df.itertuples(index=False, name=None)
+            types = ['int' if t.kind in 'iu' else 'number' if t.kind == 'f' else 'text' for t in df.dtypes]
+        elif key in EXPORT_TABLES: continue
+        else: raise ValueError(f"未知的表: {key} (可用 {', '.join(EXPORT_TABLES)})")
+        out.append((key, columns, types, rows))
+    return out
+
+def write_rows_csv(target, columns, rows):
+    """逐列寫出 CSV (utf-8-sig，Excel 可直接開啟)；target 為路徑或二進位緩衝區。回傳列數。"""
+    f = open(target, 'w', encoding='utf-8-sig', newline='') if isinstance(target, str) else io.TextIOWrapper(target, encoding='utf-8-sig', newline='')
+    n = 0
+    try:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows: writer.writerow(row); n += 1
+    finally:
+        if isinstance(target, str): f.close()
+        else: f.flush(); f.detach()
+    return n
+
+def _text_values(col):
+    # 文字欄：非字串的值 (如純數字品號) 轉成字串，NaN/None 為空值
+    return [v if isinstance(v, str) else None if v is None or v != v else str(v) for v in col]
+
+def write_rows_parquet(target, columns, types, rows, batch_rows=EXPORT_BATCH_ROWS):
+    """每 batch_rows 列轉成一個 Arrow 批次寫出；欄位型別由 types 決定 (text → string、number → float64、int → int64)，
+    NaN 一律存成空值。回傳列數。"""
+    if pq is None: raise RuntimeError("匯出 Parquet 需要安裝 pyarrow")
+    arrow_types = {'text': pa.string(), 'number': pa.float64(), 'int': pa.int64()}
+    schema = pa.schema([pa.field(c, arrow_types[t]) for c, t in zip(columns, types)])
+    rows, n = iter(rows), 0
+    with pq.ParquetWriter(target, schema) as writer:
+        for batch in iter(lambda: list(itertools.islice(rows, batch_rows)), []):
+            arrays = [pa.array(_text_values(col) if t == 'text' else col, field.type, from_pandas=True)
+                      for col, t, field in zip(zip(*batch), types, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            n += len(batch)
+    return n
+
+def write_rows_xlsx(target, sheets):
+    """write-only 模式逐列寫入 xlsx：sheets 為 [(頁名, 欄名, 列)]，單頁超過 XLSX_MAX_ROWS 列時接續到「頁名 (2)」。
+    回傳 {頁名: 列數}。"""
+    wb = Workbook(write_only=True)
+    counts = {}
+    for name, columns, rows in sheets:
+        n, ws = 0, None
+        for row in rows:
+            if n % XLSX_MAX_ROWS == 0:
+                page = n // XLSX_MAX_ROWS + 1
+                ws = wb.create_sheet(name if page == 1 else f"{name} ({page})")
+                ws.append(columns)
+            ws.append(row); n += 1
+        if ws is None: wb.create_sheet(name).append(columns)
+        counts[name] = n
+    wb.save(target)
+    return counts
+
+def export_report(result, out_path, tables=('shortage',), groups=None):
+    """串流寫出報表：.xlsx 每個表一頁；.csv / .parquet 第一個表寫到 out_path，其餘寫到「檔名_表鍵.副檔名」。
+    回傳 {表鍵: 列數}。"""
+    root, ext = os.path.splitext(out_path)
+    fmt = ext.lower().lstrip('.')
+    if fmt not in EXPORT_FORMATS: raise ValueError(f"不支援的格式: {ext} (可用 {', '.join(EXPORT_FORMATS)})")
+    parts = export_tables(result, tables, groups)
+    if fmt == 'xlsx':
+        counts = write_rows_xlsx(out_path, [(EXPORT_TABLES[key], columns, rows) for key, columns, _, rows in parts])
+        return {key: counts[EXPORT_TABLES[key]] for key, _, _, _ in parts}
+    if fmt == 'csv': return {key: write_rows_csv(out_path if i == 0 else f"{root}_{key}{ext}", columns, rows) for i, (key, columns, _, rows) in enumerate(parts)}
+    return {key: write_rows_parquet(out_path if i == 0 else f"{root}_{key}{ext}", columns, types, rows) for i, (key, columns, types, rows) in enumerate(parts)}
+
+def export_bytes(result, fmt, tables=('shortage',), groups=None):
+    """下載用：xlsx 含全部表；csv / parquet 只寫第一個表。回傳 bytes。"""
+    buf = io.BytesIO()
+    parts = export_tables(result, tables, groups)
+    if fmt == 'xlsx': write_rows_xlsx(buf, [(EXPORT_TABLES[key], columns, rows) for key, columns, _, rows in parts])
+    elif fmt == 'csv': write_rows_csv(buf, parts[0][1], parts[0][3])
+    else: write_rows_parquet(buf, *parts[0][1:])
+    return buf.getvalue()
+
+# ==========================================
+# 12. 無介面批次流程與命令列
+# ==========================================
+def load_plan_inputs(mps_data=None, supplier_files=(), recorder=None):
+    """排程檔與供應商交期檔 → (MPS 長表或 None, 到貨記錄, 訊息)。"""
+    mps_long, supplies, logs = None, [], []
+    if mps_data is not None:
+        with _stage(recorder, "mps_parse") as rec:
+            mps_long, err = parse_mps_workbook(mps_data)
+            if err: logs.append(err)
+            rec['rows_out'] = 0 if mps_long is None else len(mps_long)
+    with _stage(recorder, "supplier_parse", rows_in=len(supplier_files)) as rec:
+        for (name, _), (rows, icon, msg) in zip(supplier_files, parse_supplier_files([data for _, data in supplier_files])):
+            supplies.extend(rows)
+            logs.append(f"{icon} {name}: {msg}")
+        rec['rows_out'] = len(supplies)
+    return mps_long, supplies, logs
+
+def run_pipeline(files=FILES, stock_sources=STOCK_SOURCES, manual_plans=(), mps_data=None, supplier_files=(), ignore_days=1, model=None, today=None, recorder=None, buckets=None):
+    """完整流程 (與網頁相同的計算)：
+    manual_plans 為手動插單 (schedule.json 格式)，mps_data 為排程檔 bytes，supplier_files 為 [(檔名, bytes)]。
+    model 為 None 時與網頁「全部顯示」相同：有排程只看排程中的型號，否則涵蓋整份 BOM。
+    buckets ('D' / 'W' / 'M') 改用分期推演。回傳 (推演結果, 訊息)；
+    推演結果另含 unresolved_supplies / unresolved_models：對不到 BOM 料號的到貨與 BOM 沒有的排程型號。"""
+    master = build_master_snapshot(files, stock_sources, recorder)
+    logs = master['logs'] + [f"❌ {path}: {err}" for path, err in master['read_errors'].items()]
+    if master['bom_cols'] is None: raise ValueError("BOM 表欄位偵測失敗 (找不到型號或品號欄)")
+
+    mps_long, supplies, input_logs = load_plan_inputs(mps_data, supplier_files, recorder)
+    logs += input_logs
+    all_plans = scenario_plans({}, manual_plans, mps_long, ignore_days, today)
+
+    if model is not None: scope_models = [model]
+    else: scope_models = list(set(p['型號'] for p in all_plans)) or None
+    result = run_netting(master['df_bom_sorted'], master['bom_cols'], master['stock_table'], all_plans, supplies, scope_models, recorder, buckets, master['identity'])
+    result['total_plan_qty'] = sum(p['數量'] for p in all_plans)
+    result['unresolved_supplies'] = master['identity'].unresolved_supplies(supplies)
+    result['unresolved_models'] = master['identity'].unresolved_models(all_plans)
+    if len(result['unresolved_supplies']): logs.append(f"⚠️ {int(result['unresolved_supplies']['筆數'].sum())} 筆到貨對不到 BOM 料號 ({len(result['unresolved_supplies'])} 個品號)")
+    if len(result['unresolved_models']): logs.append(f"⚠️ 排程型號不在 BOM 中：{', '.join(result['unresolved_models']['型號'].unique())}")
+    return result, logs
+
+def _parse_named(values):
+    # NAME=VALUE 形式的參數
+    pairs = {}
+    for v in values or []:
+        name, sep, value = v.partition('=')
+        if not sep: raise argparse.ArgumentTypeError(f"格式應為 NAME=VALUE: {v}")
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+def _input_arguments(parser):
+    parser.add_argument("--bom", default=FILES["bom"], help="BOM (缺料預估) 檔案")
+    parser.add_argument("--stock", action="append", metavar="倉別=檔案", help="庫存表，可重複；未指定時使用預設 W08/W26")
+    parser.add_argument("--stock-codes", action="append", metavar="倉別=代碼,代碼", help="只計入指定庫別代碼")
+    parser.add_argument("--mps", help="排程計畫 (計畫產出) 檔案")
+    parser.add_argument("--suppliers", help="供應商交期檔所在資料夾 (*.xlsx)")
+    parser.add_argument("--plan", help="手動插單：schedule.json 格式的 JSON 或網頁使用的 schedule.db")
+    parser.add_argument("--ignore-days", type=int, default=1, help="忽略今天 + N 天內的排程")
+    parser.add_argument("--timings", help="各階段耗時另存為 JSON Lines 檔")
+    parser.add_argument("--trace-memory", action="store_true", help="同時記錄各階段峰值記憶體 (較慢)")
+
+def _read_inputs(args, parser):
+    # 命令列參數 → (files, stock_sources, 手動插單, 排程檔 bytes, [(檔名, bytes)])
+    files = {"bom": args.bom}
+    if args.stock:
+        codes = _parse_named(args.stock_codes)
+        stock_sources = {}
+        for wh, path in _parse_named(args.stock).items():
+            files[f"stock_{wh}"] = path
+            stock_sources[wh] = (f"stock_{wh}", codes[wh].split(',') if wh in codes else None)
+    else:
+        files.update({k: v for k, v in FILES.items() if k != "bom"})
+        stock_sources = STOCK_SOURCES
+
+    manual_plans = []
+    if args.plan and args.plan.endswith('.db'):
+        if not os.path.exists(args.plan): parser.error(f"找不到 {args.plan}")
+        manual_plans = PlanStore(args.plan).lines()
+    elif args.plan:
+        with open(args.plan, 'r', encoding='utf-8') as f: manual_plans = json.load(f)
+        try: manual_plans = normalize_plan_lines(manual_plans)
+        except (ValueError, KeyError, TypeError) as e: parser.error(f"{args.plan}: {e}")
+    mps_data = None
+    if args.mps:
+        with open(args.mps, 'rb') as f: mps_data = f.read()
+    supplier_files = []
+    if args.suppliers:
+        for path in sorted(glob.glob(os.path.join(args.suppliers, "*.xlsx"))):
+            with open(path, 'rb') as f: supplier_files.append((os.path.basename(path), f.read()))
+    return files, stock_sources, manual_plans, mps_data, supplier_files
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="shortage_engine", description="電池模組缺料分析 (批次模式)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="計算缺料清單並輸出報表")
+    _input_arguments(run)
+    run.add_argument("--model", help="只分析單一型號")
+    run.add_argument("--shortage-only", action="store_true", help="只輸出缺料項目")
+    run.add_argument("--buckets", choices=list(BUCKET_FREQS), help="分期推演 (日/週/月)，另輸出分期結餘表")
+    run.add_argument("--tables", default="shortage", help=f"輸出的表，逗號分隔：{', '.join(EXPORT_TABLES)} (預設 shortage)")
+    run.add_argument("--out", required=True, help="輸出檔 (.xlsx 每個表一頁；.csv / .parquet 第一個表寫到此檔，其餘為 檔名_表鍵.副檔名)")
+    scen = sub.add_parser("scenarios", help="批次情境模擬，輸出各情境與現況的缺料差異")
+    _input_arguments(scen)
+    scen.add_argument("--spec", required=True, help='情境定義 JSON：[{"name", "add": [插單], "remove": [插單 id], "replace_manual", "shift_mps_days", "ignore_days"}]')
+    scen.add_argument("--workers", type=int, help="平行行程數 (預設 CPU 數；1 為不平行)")
+    scen.add_argument("--out", required=True, help="差異報表 (.xlsx 含摘要/明細兩頁；.csv 只有明細)")
+    args = parser.parse_args(argv)
+
+    files, stock_sources, manual_plans, mps_data, supplier_files = _read_inputs(args, parser)
+    recorder = StageRecorder(args.trace_memory, memory_scope='stage') if args.timings else None
+    if args.command == "scenarios":
+        with open(args.spec, 'r', encoding='utf-8') as f: scenarios = json.load(f)
+        master = build_master_snapshot(files, stock_sources, recorder)
+        if master['bom_cols'] is None: parser.error("BOM 表欄位偵測失敗 (找不到型號或品號欄)")
+        mps_long, supplies, logs = load_plan_inputs(mps_data, supplier_files, recorder)
+        for log in master['logs'] + logs: print(log, file=sys.stderr)
+        _, summary, detail = run_scenarios(master, manual_plans, mps_long, supplies, scenarios, args.ignore_days, args.workers, recorder=recorder)
+        if args.out.lower().endswith('.csv'): detail.to_csv(args.out, index=False, encoding='utf-8-sig')
+        else:
+            with pd.ExcelWriter(args.out) as writer:
+                summary.to_excel(writer, sheet_name="摘要", index=False)
+                detail.to_excel(writer, sheet_name="明細", index=False)
+        print(summary.to_string(index=False))
+    else:
+        result, logs = run_pipeline(files, stock_sources, manual_plans, mps_data, supplier_files, args.ignore_days, args.model, recorder=recorder, buckets=args.buckets)
+        for log in logs: print(log, file=sys.stderr)
+        tables = [t.strip() for t in args.tables.split(',') if t.strip()]
+        if args.buckets and 'buckets' not in tables: tables.append('buckets')
+        # xlsx 報表一併附上對不到的到貨/型號 (有的話)
+        if args.out.lower().endswith('.xlsx'): tables += [k for k in ('unresolved_supplies', 'unresolved_models') if k not in tables and len(result[k])]
+        groups = [g for g in result['groups'] if g['final_balance'] < 0] if args.shortage_only else None
+        with _stage(recorder, "write_report", rows_in=len(result['groups'])) as rec:
+            counts = export_report(result, args.out, tables, groups)
+            rec['rows_out'] = sum(counts.values())
+        n_short = sum(1 for g in result['groups'] if g['final_balance'] < 0)
+        print(f"{len(result['groups'])} 項物料，{n_short} 項缺料 → {args.out} (" + "、".join(f"{EXPORT_TABLES[k]} {n} 列" for k, n in counts.items()) + ")")
+    if recorder is not None:
+        with open(args.timings, 'w', encoding='utf-8') as f: f.write(recorder.to_jsonl())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())